@@ -1,6 +1,7 @@
 from tkinter import messagebox
 from tkinter import *
 from filetest import Library
+from tracing import traced
 
 class AddBookPage(Frame):
     def __init__(self, parent, controller):
@@ -75,6 +76,7 @@ class AddBookPage(Frame):
             self.controller.show_frame("Dashboard")
 
     # Save Book
+    @traced("AddBookPage.save_book")
     def save_book(self):
         title = self.title_entry.get().strip()
         author = self.author_entry.get().strip()
@@ -89,10 +91,14 @@ class AddBookPage(Frame):
 
         genre_list = [genre] if genre else []
 
-        # Save to backend
-        self.controller.library.add_book(title, author, publish, cost, genre_list)
-
-        messagebox.showinfo("Success", "Book saved successfully!")
+        # Save to backend, in the background so the window doesn't freeze
+        self.controller.worker.write("add_book", title, author, publish, cost, genre_list, callback=self.book_saved)
 
         # Clear fields 
         self.clear_fields()
+
+    # called once the book is actually saved
+    @traced("AddBookPage.book_saved")
+    def book_saved(self, result):
+        self.controller.library_changed()
+        messagebox.showinfo("Success", "Book saved successfully!")
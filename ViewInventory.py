@@ -1,9 +1,18 @@
 from tkinter import *
 from tkinter import ttk, messagebox, Frame, Toplevel
+from tracing import traced
 
 
 class ViewInventoryPage(Frame):
 
+    ROW_HEIGHT = 28
+
+    # what the search box looks through, and how long to wait after the last key press before searching (ms).
+    # Shorter searches than SEARCH_MIN_LENGTH match most of the catalog, so typing doesn't start them, only the button
+    SEARCH_FIELDS = ("name", "author", "genre_tags", "publish_date", "cost")
+    SEARCH_DELAY = 200
+    SEARCH_MIN_LENGTH = 3
+
     def __init__(self, parent, controller):
         super().__init__(parent, bg="white")
 
@@ -30,6 +39,14 @@ class ViewInventoryPage(Frame):
         self.search_entry = Entry(self, width=45, font=("Courier", 12), bg="black", fg="white")
         self.search_entry.grid(row=1, column=1, padx=5, sticky="we")
 
+        # search as you type, see on_search_key(). Searches run on the worker's reader thread, search_number counts
+        # them so the results of one that was overtaken by a newer search can be dropped. searching is the text of
+        # the one that's running, or None
+        self.search_job = None
+        self.search_number = 0
+        self.searching = None
+        self.search_entry.bind("<KeyRelease>", self.on_search_key)
+
         search_btn = Button(
             self,
             text="🔍",
@@ -56,16 +73,19 @@ class ViewInventoryPage(Frame):
         self.tree = ttk.Treeview(
             self,
             columns=columns,
-            show="headings"
+            show="headings",
+            # ctrl/shift-click picks several books, delete_selected() deletes all of them
+            selectmode="extended"
         )
 
         # SCROLLBARS
-        vsb = Scrollbar(self, orient="vertical", command=self.tree.yview)
+        # the vertical scrollbar isn't hooked up to the tree, it moves through row_ids instead (see VIRTUAL TABLE)
+        self.vsb = Scrollbar(self, orient="vertical", command=self.on_scroll)
         hsb = Scrollbar(self, orient="horizontal", command=self.tree.xview)
-        self.tree.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set)
+        self.tree.configure(xscrollcommand=hsb.set)
 
         self.tree.grid(row=2, column=0, columnspan=4, sticky="nsew", padx=20, pady=(10, 0))
-        vsb.grid(row=2, column=4, sticky="ns")
+        self.vsb.grid(row=2, column=4, sticky="ns")
         hsb.grid(row=3, column=0, columnspan=4, sticky="ew")
 
         # STYLE FIX → readable headings
@@ -74,7 +94,7 @@ class ViewInventoryPage(Frame):
                         background="black",
                         foreground="white",
                         fieldbackground="black",
-                        rowheight=28,
+                        rowheight=self.ROW_HEIGHT,
                         font=("Courier", 12))
 
         style.configure("Treeview.Heading",
@@ -93,6 +113,24 @@ class ViewInventoryPage(Frame):
         for col in columns:
             self.tree.heading(col, text=col)
 
+        # VIRTUAL TABLE STATE
+        self.row_ids = []
+        self.row_set = set()
+        self.first_row = 0
+        self.rendered = {}
+
+        # library.version when the rows were last refreshed, and the search the rows came from ("" = every book)
+        self.rendered_version = None
+        self.search_text = ""
+
+        # re-render when the table is resized (more or fewer rows fit) and scroll with the mouse wheel
+        self.tree.bind("<Configure>", lambda event: self.render_rows())
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll_rows(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll_rows(3))
+        self.tree.bind("<Down>", self.on_arrow_key)
+        self.tree.bind("<Up>", self.on_arrow_key)
+
         # -----------------------------------------------------
         # BUTTONS
         # -----------------------------------------------------
@@ -138,8 +176,7 @@ class ViewInventoryPage(Frame):
         )
         self.button1.place(relx=1, rely=1, x=-10, y=-10, anchor='se')
 
-        # Initial load
-        self.load_data()
+        # the rows are loaded by refresh() when App.show_frame() shows this page
 
     # ---------------------------------------------------------
     # NORMALIZE BACKEND DATA
@@ -150,76 +187,251 @@ class ViewInventoryPage(Frame):
         else:
             stats = raw
 
+        genres = stats.get("genre_tags") or stats.get("genres") or ""
+        if isinstance(genres, (list, tuple)):
+            # shown as "fantasy, mystery" so the edit form can split it back up on the commas
+            genres = ", ".join(genres)
+
         return {
             "id": stats.get("id") or stats.get("ID") or 0,
             "title": stats.get("title") or stats.get("name") or "",
             "author": stats.get("author", ""),
             "year": stats.get("year") or stats.get("publish_date") or "",
-            "genres": stats.get("genre_tags") or stats.get("genres") or "",
+            "genres": genres,
             "cost": stats.get("cost") or stats.get("price") or ""
         }
 
+    def _row_values(self, book):
+        b = self._normalize_stats(book)
+
+        # b["id"] may be 0 — DON'T FILTER IT OUT
+        return (
+            b["id"],
+            b["title"],
+            b["author"],
+            b["year"],
+            b["genres"],
+            b["cost"]
+        )
+
+    # ---------------------------------------------------------
+    # VIRTUAL TABLE
+    # ---------------------------------------------------------
+    # the table only ever holds the rows that fit on screen. row_ids is the list of book IDs in the current view
+    # (every book, or the search results) and first_row is the position of the top row on screen. Scrolling just
+    # moves first_row and renders the few rows that are now visible, so it costs the same for 10 books or 1,000,000.
+    # each row uses its book ID as its Treeview item ID, and rendered remembers what each row is showing
+    def visible_rows(self):
+        height = self.tree.winfo_height()
+        if height <= 1:
+            # not drawn yet, use the Treeview's default height
+            return int(self.tree.cget("height"))
+        # minus one for the heading row
+        return max(1, height // self.ROW_HEIGHT - 1)
+
+    @traced("ViewInventoryPage.render_rows")
+    def render_rows(self):
+        visible = self.visible_rows()
+        total = len(self.row_ids)
+        self.first_row = max(0, min(self.first_row, total - visible))
+        window = self.row_ids[self.first_row:self.first_row + visible]
+
+        # only fetch the books that are about to be shown
+        try:
+            books = self.read("get_books", window)
+        except:
+            books = {}
+        window = [book_id for book_id in window if book_id in books]
+
+        # remove rows that scrolled out of view, then add/update/reorder only the rows that are different
+        keep = set(window)
+        for item in self.tree.get_children():
+            if item not in keep:
+                self.tree.delete(item)
+                self.rendered.pop(item, None)
+        shown = list(self.tree.get_children())
+
+        for position, book_id in enumerate(window):
+            values = self._row_values(books[book_id])
+            if book_id in self.rendered:
+                if self.rendered[book_id] != values:
+                    self.tree.item(book_id, values=values)
+                if shown[position] != book_id:
+                    self.tree.move(book_id, "", position)
+                    shown.remove(book_id)
+                    shown.insert(position, book_id)
+            else:
+                self.tree.insert("", position, iid=book_id, values=values)
+                shown.insert(position, book_id)
+            self.rendered[book_id] = values
+
+        if total:
+            self.vsb.set(self.first_row / total, (self.first_row + len(window)) / total)
+        else:
+            self.vsb.set(0, 1)
+
+    def scroll_rows(self, amount):
+        self.first_row += amount
+        self.render_rows()
+
+    def on_scroll(self, action, amount, unit=None):
+        # called by the scrollbar with ("moveto", fraction) or ("scroll", n, "units"/"pages")
+        if action == "moveto":
+            self.first_row = int(float(amount) * len(self.row_ids))
+        elif action == "scroll":
+            step = self.visible_rows() if unit == "pages" else 1
+            self.first_row += int(amount) * step
+        self.render_rows()
+
+    def on_mousewheel(self, event):
+        self.scroll_rows(-3 if event.delta > 0 else 3)
+
+    def on_arrow_key(self, event):
+        # moving past the top or bottom row with the arrow keys scrolls the table by one row
+        children = self.tree.get_children()
+        focus = self.tree.focus()
+        if not children or focus not in children:
+            return
+        if event.keysym == "Down" and focus == children[-1]:
+            self.scroll_rows(1)
+            step = 1
+        elif event.keysym == "Up" and focus == children[0]:
+            self.scroll_rows(-1)
+            step = -1
+        else:
+            return
+        children = self.tree.get_children()
+        if focus in children:
+            index = children.index(focus) + step
+            if 0 <= index < len(children):
+                self.tree.focus(children[index])
+                self.tree.selection_set(children[index])
+                return "break"
+
     # ---------------------------------------------------------
     # LOAD TABLE CONTENT
     # ---------------------------------------------------------
+    def read(self, method, *args, **kwargs):
+        # library reads go through the worker's lock, so they never see a book half way through being changed
+        return self.controller.worker.read_now(method, *args, **kwargs)
+
+    def set_rows(self, row_ids, version):
+        # version should be read before row_ids were fetched, so a change that lands in between gets picked up
+        # again by the next refresh() instead of being missed
+        self.row_ids = row_ids
+        self.row_set = set(row_ids)
+        self.rendered_version = version
+
+    @traced("ViewInventoryPage.load_data")
     def load_data(self):
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-
+        # full reload of every book, also clears the search (and drops the results of one still running)
+        self.search_text = ""
+        self.cancel_search()
+        version = self.controller.library.version
         try:
-            books = self.controller.library.stats_inventory()
+            self.set_rows(self.read("book_ids"), version)
         except:
-            books = {}
+            self.set_rows([], version)
 
-        for book_id, book in books.items():
-            b = self._normalize_stats(book)
-
-            # b["id"] may be 0 — DON'T FILTER IT OUT
-            self.tree.insert(
-                "",
-                "end",
-                values=(
-                    b["id"],
-                    b["title"],
-                    b["author"],
-                    b["year"],
-                    b["genres"],
-                    b["cost"]
-                )
-            )
+        self.render_rows()
 
     # ---------------------------------------------------------
-    # SEARCH
+    # REFRESH ONLY WHAT CHANGED
     # ---------------------------------------------------------
-    def search_book(self):
-        keyword = self.search_entry.get().strip().lower()
+    @traced("ViewInventoryPage.refresh")
+    def refresh(self):
+        """
+        brings the table up to date after books were added, edited or deleted. The library's change log says which
+        books changed since the last refresh, so only those rows get touched instead of rebuilding the table
+        """
+        version = self.controller.library.version
+        if self.searching or self.search_text:
+            # search results come from the index anyway, so just run the search again (or the one still running)
+            self.start_search(self.searching or self.search_text, version)
+            return
 
-        if not keyword:
+        changed = None
+        if self.rendered_version is not None:
+            changed = self.read("changes_since", self.rendered_version)
+        if changed is None:
             self.load_data()
             return
+        if not changed:
+            return
 
-        try:
-            books = self.controller.library.stats_inventory()
-        except:
-            books = {}
+        existing = self.read("get_books", changed)
+        removed = {book_id for book_id in changed if book_id not in existing and book_id in self.row_set}
+        if removed:
+            self.row_ids = [book_id for book_id in self.row_ids if book_id not in removed]
+            self.row_set -= removed
+        for book_id in sorted(existing, key=int):
+            if book_id not in self.row_set:
+                self.row_ids.append(book_id)
+                self.row_set.add(book_id)
+        self.rendered_version = version
 
-        for row in self.tree.get_children():
-            self.tree.delete(row)
+        # edited rows are picked up by render_rows() because their values no longer match what's shown
+        self.render_rows()
 
-        for book_id, book in books.items():
-            b = self._normalize_stats(book)
+    # ---------------------------------------------------------
+    # SEARCH
+    # ---------------------------------------------------------
+    def on_search_key(self, event=None):
+        # waits until typing pauses before searching, every new key press cancels the search that was waiting
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(self.SEARCH_DELAY, lambda: self.search_book(typed=True))
+
+    @traced("ViewInventoryPage.search_book")
+    def search_book(self, typed=False):
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+            self.search_job = None
 
-            combo = f"{b['title']} {b['author']} {b['year']} {b['genres']} {b['cost']}".lower()
+        keyword = self.search_entry.get().strip().lower()
+
+        if not keyword:
+            if self.search_text or self.rendered_version is None:
+                self.load_data()
+            return
+        if keyword == self.search_text or (typed and len(keyword) < self.SEARCH_MIN_LENGTH):
+            # the table keeps what it shows, a search that's still running for something else gets dropped
+            self.cancel_search()
+            return
 
-            if keyword in combo:
-                self.tree.insert("", "end", values=(
-                    b["id"],
-                    b["title"],
-                    b["author"],
-                    b["year"],
-                    b["genres"],
-                    b["cost"]
-                ))
+        # the library's search index finds the matches, and only the ones on screen get rendered.
+        # if the new search just adds letters to the last one (and nothing changed since), every match has to be
+        # in the last results, so only those get checked
+        version = self.controller.library.version
+        narrow = (self.search_text and keyword.startswith(self.search_text)
+                  and self.rendered_version == version)
+        self.start_search(keyword, version, list(self.row_ids) if narrow else None)
+
+    def start_search(self, keyword, version, within=None):
+        # sends the search to the worker, so the page doesn't freeze while it runs or waits for the writer
+        self.search_number += 1
+        self.searching = keyword
+        number = self.search_number
+
+        def found(books):
+            if number == self.search_number:
+                self.searching = None
+                self.show_search(keyword, books, version)
+
+        self.controller.worker.read("search", keyword, fields=self.SEARCH_FIELDS, within=within, callback=found,
+                                    on_error=lambda error: found({}))
+
+    def cancel_search(self):
+        self.search_number += 1
+        self.searching = None
+
+    @traced("ViewInventoryPage.show_search")
+    def show_search(self, keyword, books, version):
+        if keyword != self.search_text:
+            self.first_row = 0
+        self.search_text = keyword
+        self.set_rows(list(books), version)
+        self.render_rows()
 
     # ---------------------------------------------------------
     # EDIT SELECTED
@@ -259,29 +471,21 @@ class ViewInventoryPage(Frame):
                 return
 
             new_title, new_author, new_year, new_genres, new_cost = new_vals
+            genre_list = [genre.strip() for genre in new_genres.split(",") if genre.strip()]
 
-            # Update TreeView
-            self.tree.item(sel[0], values=(
-                book_id, new_title, new_author, new_year, new_genres, new_cost
-            ))
-
-            # Update backend
-            try:
-                data = {
-                    "title": new_title,
-                    "author": new_author,
-                    "publish_year": new_year,
-                    "genres": new_genres,
-                    "cost": new_cost
-                }
-                if hasattr(self.controller.library, "update_book"):
-                    self.controller.library.update_book(book_id, data)
-
-            except Exception:
-                messagebox.showwarning("Warning", "Backend update may have failed.")
+            def saved(result):
+                if result is False:
+                    messagebox.showwarning("Warning", "Backend update may have failed.")
+                self.refresh()
+
+            # Update backend in the background, the row itself gets updated by refresh() once it's saved
+            self.controller.worker.write("edit_book", book_id, name=new_title, author=new_author,
+                                         publish_date=new_year, cost=new_cost, genre=genre_list,
+                                         callback=saved,
+                                         on_error=lambda error: messagebox.showwarning(
+                                             "Warning", "Backend update may have failed."))
 
             form.destroy()
-            self.load_data()
 
         Button(
             form, text="Save Changes",
@@ -300,21 +504,26 @@ class ViewInventoryPage(Frame):
             messagebox.showwarning("Warning", "Select a book to delete.")
             return
 
-        values = self.tree.item(sel[0], "values")
-        book_id = values[0]
-        title = values[1]
+        # the row iids are the book IDs, so every selected row can be deleted without reading its values
+        book_ids = list(sel)
+        if len(book_ids) == 1:
+            question = f"Delete '{self.tree.item(sel[0], 'values')[1]}'?"
+        else:
+            question = f"Delete {len(book_ids)} books?"
 
-        if not messagebox.askyesno("Confirm", f"Delete '{title}'?"):
+        if not messagebox.askyesno("Confirm", question):
             return
 
-        try:
-            # if hasattr(self.controller.library, "delete_book_by_id"):
-               #self.controller.library.delete_book_by_id(book_id)
-            self.controller.library.delete_book(book_id)
-        except:
-            messagebox.showwarning("Warning", "Backend delete failed.")
+        def deleted(result):
+            if not result:
+                messagebox.showwarning("Warning", "Backend delete failed.")
+            self.refresh()
 
-        self.load_data()
+        # if hasattr(self.controller.library, "delete_book_by_id"):
+           #self.controller.library.delete_book_by_id(book_id)
+        # one call (and one write) for the whole selection, and one refresh once it's done
+        self.controller.worker.write("delete_books", book_ids, callback=deleted,
+                                     on_error=lambda error: messagebox.showwarning("Warning", "Backend delete failed."))
 
     # ---------------------------------------------------------
     # AUTO-REFRESH AFTER ADD BOOK
@@ -324,4 +533,4 @@ class ViewInventoryPage(Frame):
         self.controller.show_frame("AddBookPage")
 
         # refresh when page returns
-        self.after(300, self.load_data)
\ No newline at end of file
+        self.after(300, self.refresh)
\ No newline at end of file
@@ -0,0 +1,258 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from filetest import Library
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, max_rss_mb is just left out there
+    resource = None
+
+
+# benchmarks for filetest.Library on made up catalogs of different sizes
+#   python benchmark.py run --sizes 1000 10000 --output new.json
+#   python benchmark.py compare old.json new.json
+SIZES = (1000, 10000, 100000, 1000000)
+
+# how many times each single-book operation is timed per catalog size
+OPERATIONS = 200
+QUERIES = 20
+
+WORDS = ("house", "river", "night", "garden", "shadow", "king", "winter", "glass", "letter", "island", "storm",
+         "secret", "empire", "road", "dream", "fire", "silver", "forest", "city", "song", "war", "child", "ocean")
+GENRES = ("fantasy", "mystery", "romance", "science fiction", "historical fiction", "horror", "biography",
+          "poetry", "thriller", "children's fiction", "family saga", "absurdist fiction")
+
+
+def make_rows(count, seed=0):
+    """
+    generator of count made up books, in the same dict format import_books() takes
+    """
+    rng = random.Random(seed)
+    authors = [f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}son" for i in range(max(10, count // 20))]
+    for i in range(count):
+        yield {
+            "name": " ".join(rng.choice(WORDS) for j in range(rng.randint(2, 5))).capitalize() + f" {i}",
+            "author": rng.choice(authors),
+            "publish_date": rng.randint(1700, 2024),
+            "cost": rng.randint(5, 300),
+            "genre_tags": rng.sample(GENRES, rng.randint(1, 3))
+        }
+
+
+def summarize(latencies):
+    """
+    turns a list of call times (seconds) into throughput and latency percentiles
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+    return {
+        "calls": len(ordered),
+        "total_seconds": total,
+        "ops_per_second": len(ordered) / total if total else None,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000
+    }
+
+
+def time_calls(function, arguments):
+    latencies = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def time_once(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return summarize([time.perf_counter() - start])
+
+
+def run_size(size, directory, seed=0):
+    """
+    builds a catalog of size books in directory and times every Library operation on it
+    """
+    rng = random.Random(seed)
+    file_name = os.path.join(directory, f"books_{size}")
+    results = {}
+
+    # build the catalog, and measure the peak memory of the in-memory library while it's filled
+    tracemalloc.start()
+    library = Library(file_name)
+    results["import_books"] = time_once(library.import_books, make_rows(size, seed))
+    results["import_books"]["ops_per_second"] = size / results["import_books"]["total_seconds"]
+    build_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    library.close()
+
+    # cold open in lazy mode, which only reads the IDs and the saved indexes
+    tracemalloc.start()
+    start = time.perf_counter()
+    library = Library(file_name, lazy=True)
+    results["open_lazy"] = summarize([time.perf_counter() - start])
+    lazy_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    library.close()
+
+    # cold open of the shelf that was just written
+    tracemalloc.start()
+    start = time.perf_counter()
+    library = Library(file_name)
+    results["open"] = summarize([time.perf_counter() - start])
+    open_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    ids = library.book_ids()
+    sample = rng.sample(ids, min(OPERATIONS, len(ids)))
+    words = [(rng.choice(WORDS),) for i in range(QUERIES)]
+
+    results["add_book"] = time_calls(library.add_book, [
+        (f"Added book {i}", "Bench Author", 2000, 10, ["fantasy"]) for i in range(OPERATIONS)])
+    results["edit_book"] = time_calls(lambda book_id: library.edit_book(book_id, cost=rng.randint(5, 300)),
+                                      [(book_id,) for book_id in sample])
+
+    filters = {
+        "name": lambda word: library.apply_filter(name=word),
+        "author": lambda word: library.apply_filter(author=word),
+        "publish": lambda word: library.apply_filter(publish=rng.randint(1700, 2024)),
+        "cost": lambda word: library.apply_filter(cost=rng.randint(5, 300)),
+        "genre_tags": lambda word: library.apply_filter(genre_tags=[rng.choice(GENRES)]),
+        "year_between": lambda word: library.apply_filter(year_between=(1900, 1950)),
+        "cost_max": lambda word: library.apply_filter(cost_max=50)
+    }
+    for kind, function in filters.items():
+        results[f"apply_filter[{kind}]"] = time_calls(function, words)
+
+    results["search"] = time_calls(library.search, words)
+    results["stats_tags"] = time_calls(library.stats_tags, [()] * QUERIES)
+    results["stats_books"] = time_calls(library.stats_books, [()] * QUERIES)
+    results["delete_book"] = time_calls(library.delete_book, [(book_id,) for book_id in sample])
+    batch = library.book_ids()[:max(1, size // 10)]
+    results["delete_books"] = time_once(library.delete_books, batch)
+    results["delete_all_books"] = time_once(library.delete_all_books)
+    library.close()
+
+    return {
+        "size": size,
+        "operations": results,
+        "build_peak_memory_mb": build_peak / 1e6,
+        "open_peak_memory_mb": open_peak / 1e6,
+        "open_lazy_peak_memory_mb": lazy_peak / 1e6
+    }
+
+
+def run(sizes, output, seed=0):
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "sizes": {}
+    }
+    for size in sizes:
+        print(f"benchmarking {size} books...", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as directory:
+            # Library prints a line for every book, which would drown everything else (and slow it down)
+            with contextlib.redirect_stdout(io.StringIO()):
+                report["sizes"][str(size)] = run_size(size, directory, seed)
+        if resource is not None:
+            # ru_maxrss is in KB on Linux and bytes on macOS
+            scale = 1e6 if sys.platform == "darwin" else 1e3
+            report["sizes"][str(size)]["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        print_size(report["sizes"][str(size)])
+
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"results written to {output}")
+    return report
+
+
+def print_size(result):
+    print(f"\n{result['size']} books (build peak {result['build_peak_memory_mb']:.1f} MB, "
+          f"open peak {result['open_peak_memory_mb']:.1f} MB, "
+          f"lazy open peak {result['open_lazy_peak_memory_mb']:.1f} MB)")
+    print(f"{'operation':<26}{'ops/s':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for name, summary in result["operations"].items():
+        print(f"{name:<26}{summary['ops_per_second'] or 0:>12.1f}{summary['p50_ms']:>10.3f}"
+              f"{summary['p90_ms']:>10.3f}{summary['p99_ms']:>10.3f}")
+
+
+def compare(old_file, new_file, threshold=0.10, min_ms=0.05):
+    """
+    compares the p50 latency of every operation between two result files. Anything more than threshold (10%)
+    slower counts as a regression, unless it got slower by less than min_ms (timer noise on very fast calls).
+    Returns how many regressions were found
+    """
+    with open(old_file) as file:
+        old = json.load(file)
+    with open(new_file) as file:
+        new = json.load(file)
+
+    regressions = 0
+    for size, new_result in new["sizes"].items():
+        old_result = old["sizes"].get(size)
+        if old_result is None:
+            continue
+        print(f"\n{size} books")
+        print(f"{'operation':<26}{'old p50 ms':>12}{'new p50 ms':>12}{'change':>10}")
+        for name, summary in new_result["operations"].items():
+            if name not in old_result["operations"]:
+                continue
+            before = old_result["operations"][name]["p50_ms"]
+            after = summary["p50_ms"]
+            change = (after - before) / before if before else 0.0
+            flag = ""
+            if change > threshold and after - before >= min_ms:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{name:<26}{before:>12.3f}{after:>12.3f}{change:>+10.1%}{flag}")
+        for key in ("build_peak_memory_mb", "open_peak_memory_mb", "open_lazy_peak_memory_mb"):
+            before, after = old_result.get(key), new_result.get(key)
+            if before and after:
+                print(f"{key:<26}{before:>12.1f}{after:>12.1f}{(after - before) / before:>+10.1%}")
+
+    print(f"\n{regressions} regression(s) over {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Library benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the library and save the results")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="catalog sizes to test")
+    run_parser.add_argument("--output", default="bench_results.json", help="where to write the results")
+    run_parser.add_argument("--seed", type=int, default=0)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="how much slower (0.10 = 10%%) counts as a regression")
+    compare_parser.add_argument("--min-ms", type=float, default=0.05,
+                                help="ignore p50 changes smaller than this many milliseconds")
+    arguments = parser.parse_args()
+
+    if arguments.command == "run":
+        run(arguments.sizes, arguments.output, arguments.seed)
+    else:
+        sys.exit(1 if compare(arguments.old, arguments.new, arguments.threshold, arguments.min_ms) else 0)
@@ -1,13 +1,37 @@
-import shelve
 import pickle
+import bisect
+import copy
 import json
 import dbm
+import csv
+import io
+import os
+import time
+import sys
+import math
+from contextlib import contextmanager, nullcontext
+
+from indexes import GenreIndex, TextIndex, SortedIndex, StatsAggregator, to_number
+from storage import open_backend, LazyInventory, InventoryView
+from snapshot import open_snapshot, write_snapshot, stamp_snapshot, store_stamp
+from sharing import Sharing, SharedBackend
+
+
+def intern_text(value):
+    # authors, genres and (copies of) titles repeat a lot, so every book with the same text shares one string
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
 
 
 class Book:
     """
     A book object that holds info similar to a book irl
+
+    Book uses __slots__ instead of a __dict__ per book, which makes every book in memory a lot smaller
     """
+    __slots__ = ("name", "author", "publish_date", "cost", "ID", "genre_tags")
+
     def __init__(self, name, author, publish_date, cost, ID, genre_tags=()):
         """
         name: name of the book
@@ -16,15 +40,30 @@ class Book:
         cost: a generic cost value, I don't know what we will do with it
         genre_tags: tags that can be searched through, default of (), pass through iterables
         """
-        self.name = name
-        self.author = author
+        self.name = intern_text(name)
+        self.author = intern_text(author)
         self.publish_date = publish_date
         self.cost = cost
         self.ID = ID
         self.genre_tags = []
         if genre_tags:
             for i in genre_tags:
-                self.genre_tags.append(i)
+                self.genre_tags.append(intern_text(i))
+
+    def __getstate__(self):
+        # pickled as a plain dict, the same way books were saved before __slots__, so old and new shelves both work
+        return {i: getattr(self, i) for i in self.__slots__}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (None, slots) is how pickle saves a __slots__ object by default
+            state = state[1]
+        for i in self.__slots__:
+            setattr(self, i, state.get(i))
+        self.name = intern_text(self.name)
+        self.author = intern_text(self.author)
+        if isinstance(self.genre_tags, list):
+            self.genre_tags = [intern_text(i) for i in self.genre_tags]
 
     def __str__(self):
         """
@@ -44,68 +83,939 @@ class Book:
         return stats
 
 
+def read_book_rows(source, format=None):
+    """
+    generator that yields one dict per book from a csv file, one line per book from a jsonl file (decoded by
+    parse_book_row(), so a bad line only rejects that row), or passes through an iterable of dicts as-is
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        yield from source
+        return
+    if format is None:
+        format = os.path.splitext(str(source))[1].lstrip(".").lower()
+    if format == "csv":
+        with open(source, newline="", encoding="utf-8") as file:
+            yield from csv.DictReader(file)
+    elif format in ("jsonl", "json"):
+        with open(source, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield line
+    else:
+        raise ValueError(f"unknown import format: {format}")
+
+
+def parse_book_row(row):
+    """
+    checks one imported row and turns it into (name, author, publish_date, cost, genre_tags)
+    row: a dict, or a line of JSON that decodes to one (from a .jsonl file)
+    raises ValueError with the reason if the row can't be used
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError as error:
+            raise ValueError(f"not valid JSON: {error}")
+    if not isinstance(row, dict):
+        raise ValueError(f"a row has to be a dictionary of fields, not {type(row).__name__}")
+
+    name = str(row.get("name") or row.get("title") or "").strip()
+    author = str(row.get("author") or "").strip()
+    if not name or not author:
+        raise ValueError("name and author are required")
+
+    publish = parse_publish_date(row.get("publish_date", row.get("publish", row.get("year", ""))))
+    cost = parse_cost(row.get("cost", ""))
+    genre_tags = parse_genre_tags(row.get("genre_tags", row.get("genre", ())))
+    return name, author, publish, cost, genre_tags
+
+
+# the checks parse_book_row() makes on each field, also used on their own for edits that only send some fields.
+# Each one raises ValueError with the reason
+
+def parse_publish_date(publish):
+    # a year as an int, or "" / None for a book without one
+    if publish in ("", None):
+        return publish
+    try:
+        return int(publish)
+    except (TypeError, ValueError, OverflowError):
+        # OverflowError is for an infinite float
+        raise ValueError(f"publish_date is not a year: {publish!r}")
+
+
+def parse_cost(cost):
+    # a number (an int if it's a whole one), or "" / None for a book without one
+    if cost in ("", None):
+        return cost
+    try:
+        number = float(cost)
+    except (TypeError, ValueError):
+        raise ValueError(f"cost is not a number: {cost!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"cost is not a number: {cost!r}")
+    cost = number
+    if cost.is_integer():
+        cost = int(cost)
+    return cost
+
+
+def parse_genre_tags(genre_tags):
+    # a list of tags
+    genre_tags = genre_tags or ()
+    if isinstance(genre_tags, str):
+        # csv files keep all the tags in one column, separated by semicolons
+        genre_tags = split_tags(genre_tags)
+    try:
+        genre_tags = list(genre_tags)
+    except TypeError:
+        raise ValueError(f"genre_tags is not a list: {genre_tags!r}")
+    if not all(isinstance(tag, str) for tag in genre_tags):
+        raise ValueError(f"genre_tags can only hold text: {genre_tags!r}")
+    return genre_tags
+
+
+def join_tags(genre_tags):
+    # puts the tags in one csv column, separated by semicolons. A semicolon or backslash in a tag gets a backslash
+    # in front of it, so split_tags() gives back the same tags
+    return ";".join(tag.replace("\\", "\\\\").replace(";", "\\;") for tag in genre_tags)
+
+
+def split_tags(text):
+    # the tags from a csv column written by join_tags() (or by hand)
+    tags = []
+    tag = []
+    escaped = False
+    for char in text:
+        if escaped:
+            tag.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == ";":
+            tags.append("".join(tag))
+            tag = []
+        else:
+            tag.append(char)
+    tags.append("".join(tag))
+    return [tag.strip() for tag in tags if tag.strip()]
+
+
+def build_indexes(books):
+    """
+    builds every index for books from scratch (books can be a generator, each book is only looked at once)
+    returns (genre_index, text_index, year_index, cost_index, stats)
+    """
+    indexes = (GenreIndex(), TextIndex(), SortedIndex("publish_date"), SortedIndex("cost"), StatsAggregator())
+    genre_index, text_index, year_index, cost_index, stats = indexes
+    for book in books:
+        genre_index.add(book)
+        text_index.add(book)
+        stats.add(book)
+        year_index.append(book)
+        cost_index.append(book)
+    year_index.sort()
+    cost_index.sort()
+    return indexes
+
+
+def combine_bounds(field, exact, between, low, high):
+    """
+    turns every bound given for one field (an exact value, a (low, high) pair and the one-sided low and high) into
+    the single range that satisfies all of them, as (low, high) numbers with None for an open end. An exact value
+    that isn't a number is left out, apply_filter() compares those the old way
+    raises ValueError if a range bound isn't a number
+    """
+    lows = []
+    highs = []
+    if exact and to_number(exact) is not None:
+        lows.append(exact)
+        highs.append(exact)
+    if between:
+        between_low, between_high = between
+        lows.append(between_low)
+        highs.append(between_high)
+    lows.append(low)
+    highs.append(high)
+
+    def numbers(values):
+        found = []
+        for value in values:
+            if value is None:
+                continue
+            number = to_number(value)
+            if number is None:
+                raise ValueError(f"{field} bound is not a number: {value!r}")
+            found.append(number)
+        return found
+
+    lows = numbers(lows)
+    highs = numbers(highs)
+    return max(lows) if lows else None, min(highs) if highs else None
+
+
 class Library:
-    def __init__(self, file_name):
+    def __init__(self, file_name, autoflush=True, reuse_IDs=False, backend="shelve", lazy=False, cache_size=10000,
+                 access=None):
         """
-        shelve_file: a direct link to the shelf file on the computer (which by default is in the same folder as the program)
+        store: where the books are saved on the computer (which by default is in the same folder as the program).
+                backend picks what kind: "shelve" (the default, a shelf file), "sqlite" (a SQLite database), or an
+                already open backend object from storage.py
         inventory: a dictionary that stores the same files as the shelf. It's basically a cache where changes are made before
                 the shelf gets updated in a single batch
+        lazy: when True, inventory is a storage.LazyInventory instead, which only keeps the IDs in memory and reads
+                books from the shelf when they're used, keeping the last cache_size of them. Together with the indexes
+                saved by close(), opening a big shelf this way is almost instant
         filtered_inventory: a dictionary that stores a subset of the main inventory after applying search filters. Updated
                 after each time the apply_filter() function is called
-        current_ID: an internal counter for managing the IDs of books
+        current_ID: the next unused ID (a high-water mark). It's saved in the store with every flush, together with
+                free_IDs, so it survives restarts and crashes
+        reuse_IDs: when True, IDs of deleted books are handed out again before new ones
+        free_IDs: the deleted IDs waiting to be reused (only filled when reuse_IDs is True)
+        snapshot_file: the file next to the shelf that close() saves every book and index to (see snapshot.py)
+        snapshot: the snapshot this library was opened from, read in place with mmap. None if there wasn't one, or
+                if the shelf has changed since it was written, in which case everything is loaded from the shelf
+        meta_file: where older versions saved current_ID, free_IDs and the indexes, still read if there's no snapshot
+        genre_index: maps each genre tag to the IDs of the books that have it, kept up to date on every change
+        text_index: a trigram index over titles, authors, genres, years and costs that answers search() and the
+                name/author filters
+        year_index, cost_index: publish dates and costs kept sorted as numbers, for the range filters in apply_filter()
+        stats: running totals (genre counts, title counts, costs per genre) for the stats_ functions
+        filtered_stats: the same totals for filtered_inventory, built by apply_filter() and kept up to date when a
+                filtered book is edited or deleted
+        autoflush: when True (the default), every change is written to the shelf right away. When False, changes
+                stay in inventory until flush() is called
+        dirty_keys: the IDs of books that have changed in inventory but haven't been written to the shelf yet
+        records_written: how many records have been written to (or deleted from) the shelf so far
+        flush_count: how many times flush() has actually written something
+        version: goes up by one every time a book is added, edited or deleted
+        change_log: (version, book ID) for the most recent changes, so a page can ask what changed since it last looked
+        metrics: None, or the LibraryMetrics timing every call after enable_metrics() is used
+        undo_log: only used inside transaction(), a copy of every book as it was before the transaction first
+                changed it (None for books that didn't exist yet), so the changes can be rolled back
+        access: None (the default) if only this program uses the shelf. When several programs open the same shelf,
+                one of them uses "writer" and the rest "reader" (see sharing.py). A reader can't change anything and
+                calls sync_changes() to pick up what the writer changed. Opening a second writer raises
+                sharing.LibraryLockedError
+        sharing: the sharing.Sharing with the file locks and change journal, or None if access is None
+        """
+        self.access = access
+        self.sharing = Sharing(file_name, access) if access is not None else None
+
+        # a shared library is loaded under the shared lock, so the writer can't change the shelf halfway through and
+        # the journal position matches what was loaded
+        with self.shared_lock():
+            # the shelf files are stamped before they're opened, opening some stores touches them
+            stamp = store_stamp(file_name)
+            self.store = open_backend(file_name, backend, Book, readonly=access == "reader",
+                                      shared=access is not None)
+            if self.sharing is not None:
+                self.store = SharedBackend(self.store, self.sharing)
+            self.file_name = file_name
+            self.snapshot_file = file_name + ".snap"
+            self.snapshot = open_snapshot(self.snapshot_file, stamp, len(self.store))
+            self.lazy = lazy
+            self.cache_size = cache_size
+            self.inventory = self.open_inventory(self.snapshot)
+            self.filtered_inventory = self.subset()
+            self.current_ID = 0
+            self.reuse_IDs = reuse_IDs
+            self.free_IDs = []
+            self.meta_file = file_name + ".meta"
+            self.genre_index = GenreIndex()
+            self.text_index = TextIndex()
+            self.year_index = SortedIndex("publish_date")
+            self.cost_index = SortedIndex("cost")
+            self.stats = StatsAggregator()
+            self.filtered_stats = StatsAggregator()
+            self.autoflush = autoflush
+            self.dirty_keys = set()
+            self.records_written = 0
+            self.flush_count = 0
+            self.version = 0
+            self.change_log = []
+            self.metrics = None
+            self.undo_log = None
+            self.load_meta()
+            self.load_counters()
+            if self.sharing is not None:
+                self.sharing.journal.start()
+
+    def shared_lock(self):
+        # the shared file lock of a shared library, or nothing
+        if self.sharing is None:
+            return nullcontext()
+        return self.sharing.lock.shared()
+
+    def check_writable(self):
+        # readers of a shared library can't change it, only the writer can
+        if self.access == "reader":
+            raise PermissionError(f"{self.file_name} is open read-only, another program is writing to it")
+
+    def open_inventory(self, snapshot=None):
+        # every book (read from the snapshot if there's an up to date one), or just their IDs in lazy mode
+        if self.lazy:
+            return LazyInventory(self.store, self.cache_size, snapshot, Book)
+        if snapshot is not None:
+            return snapshot.load_all(Book)
+        return self.store.load_all()
+
+    def subset(self, ids=()):
+        # a dictionary for part of the inventory. In lazy mode it only keeps the IDs and looks books up when used
+        if self.lazy:
+            return InventoryView(self.inventory, ids)
+        return {i: self.inventory[i] for i in ids}
+
+    def cache_stats(self):
+        """
+        returns how well the lazy inventory's cache is doing (books, cached, pending, hits, misses, hit_rate), or None
+        if the library isn't lazy
+        """
+        if self.lazy:
+            return self.inventory.cache_stats()
+        return None
+
+    def load_meta(self):
+        """
+        loads the saved ID counter and indexes from the snapshot. The sorted indexes are read straight from the mapped
+        file, the rest is unpickled. Without an up to date snapshot, an old meta_file is used if there is one (it's
+        removed once it's read), and otherwise the counter and indexes are rebuilt from inventory
+        """
+        if self.snapshot is not None:
+            meta = self.snapshot.meta()
+            self.current_ID = meta["current_ID"]
+            self.free_IDs = list(meta["free_IDs"])
+            self.genre_index = GenreIndex(meta["genre_index"])
+            self.text_index = TextIndex(*meta["text_index"])
+            self.year_index = SortedIndex("publish_date", self.snapshot.year_entries())
+            self.cost_index = SortedIndex("cost", self.snapshot.cost_entries())
+            self.stats = meta["stats"]
+            return
+
+        try:
+            with open(self.meta_file, "rb") as file:
+                meta = pickle.load(file)
+            if self.access != "reader":
+                os.remove(self.meta_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            meta = None
+
+        if meta and meta.get("book_count") == len(self.inventory):
+            try:
+                if set(meta["text_index"][1]) != set(TextIndex.FIELDS):
+                    # the text index didn't cover every field yet
+                    raise KeyError("text_index")
+                self.current_ID = meta["current_ID"]
+                self.free_IDs = list(meta["free_IDs"])
+                self.genre_index = GenreIndex(meta["genre_index"])
+                self.text_index = TextIndex(*meta["text_index"])
+                self.year_index = SortedIndex("publish_date", meta["year_index"])
+                self.cost_index = SortedIndex("cost", meta["cost_index"])
+                self.stats = meta["stats"]
+                return
+            except KeyError:
+                # saved by an older version that didn't have every index yet
+                pass
+        self.current_ID = max((int(i) for i in self.inventory if i.isdigit()), default=-1) + 1
+        self.free_IDs = []
+        self.rebuild_indexes()
+
+    def rebuild_indexes(self):
+        """
+        builds every index from scratch by going through the whole inventory
+        """
+        self.genre_index, self.text_index, self.year_index, self.cost_index, self.stats = \
+            build_indexes(self.inventory.values())
+
+    def repair_indexes(self):
+        # after a change failed part way through the indexes: builds them and filtered_stats again from the books
+        self.rebuild_indexes()
+        self.filtered_stats = StatsAggregator()
+        for i in self.filtered_inventory:
+            self.filtered_stats.add(self.filtered_inventory[i])
+
+    def index_book(self, book):
+        # adds a book to every index, call this after a book is added or changed
+        self.genre_index.add(book)
+        self.text_index.add(book)
+        self.year_index.add(book)
+        self.cost_index.add(book)
+        self.stats.add(book)
+        if str(book.ID) in self.filtered_inventory:
+            self.filtered_stats.add(book)
+
+    def index_books(self, books):
+        # same as index_book() for a whole batch, the sorted indexes only get sorted once at the end. Each book is only
+        # looked at once, so books can be a generator (a lazy library doesn't have to hold them all at the same time)
+        for book in books:
+            self.genre_index.add(book)
+            self.text_index.add(book)
+            self.stats.add(book)
+            self.year_index.append(book)
+            self.cost_index.append(book)
+        self.year_index.sort()
+        self.cost_index.sort()
+
+    def unindex_book(self, book):
+        # takes a book out of every index, call this before a book is changed or deleted
+        self.genre_index.remove(book)
+        self.text_index.remove(book)
+        self.year_index.remove(book)
+        self.cost_index.remove(book)
+        self.stats.remove(book)
+        if str(book.ID) in self.filtered_inventory:
+            self.filtered_stats.remove(book)
+
+    def save_meta(self):
+        """
+        writes every book, the ID counter and the indexes to a new snapshot under a temporary name, so the next
+        Library(...) doesn't have to load the shelf or rebuild them. close() stamps it and puts it in place once the
+        shelf is closed. If nothing changed since the library was opened from a snapshot, that one is kept and
+        nothing is written. returns how many bytes were written
+        """
+        self.flush()
+        if self.snapshot is not None and self.version == 0:
+            return 0
+        meta = {
+            "current_ID": self.current_ID,
+            "free_IDs": self.free_IDs,
+            "genre_index": self.genre_index.tags,
+            "text_index": (self.text_index.postings, self.text_index.values),
+            "stats": self.stats
+        }
+        return write_snapshot(self.snapshot_file + ".tmp", self.iter_books(), self.year_index.entries,
+                              self.cost_index.entries, meta)
+
+    # how many changes change_log remembers, older ones are forgotten and asking about them means a full reload
+    MAX_CHANGE_LOG = 10000
+
+    def mark_dirty(self, book_id):
+        """
+        remembers that a book has changed so only that record gets written on the next flush, and logs the change
+        under a new version number for changes_since()
+        """
+        self.dirty_keys.add(str(book_id))
+        if self.lazy:
+            self.inventory.hold(str(book_id))
+        self.log_change(book_id)
+        if self.autoflush:
+            self.flush()
+
+    def log_change(self, book_id):
+        # a new version number, with the book that changed in it
+        self.version += 1
+        self.change_log.append((self.version, str(book_id)))
+        if len(self.change_log) > self.MAX_CHANGE_LOG:
+            del self.change_log[:len(self.change_log) - self.MAX_CHANGE_LOG // 2]
+
+    def changes_since(self, version):
+        """
+        returns the set of IDs of books that were added, edited or deleted after the given version, or None if that
+        version is too old to still be in change_log (the caller should reload everything in that case)
+        """
+        if version == self.version:
+            return set()
+        if version > self.version or not self.change_log or self.change_log[0][0] > version + 1:
+            return None
+        start = bisect.bisect_left(self.change_log, (version + 1,))
+        return {book_id for change_version, book_id in self.change_log[start:]}
+
+    def id_counters(self):
+        # current_ID and free_IDs the way they're written to the store
+        return {"current_ID": self.current_ID, "free_IDs": list(self.free_IDs)}
+
+    def load_counters(self):
+        """
+        reads current_ID and free_IDs back from the store. They're written with every flush, so they're newer than
+        the ones in a snapshot or .meta file if the program stopped without close()
+        """
+        self.set_counters(self.store.load_counters())
+
+    def set_counters(self, counters):
+        # counters as load_counters() reads them, None if the store doesn't have any yet
+        if counters is not None:
+            self.current_ID = max(self.current_ID, counters["current_ID"])
+            self.free_IDs = list(counters["free_IDs"])
+
+    def flush(self):
+        """
+        writes every dirty book to the shelf. Books that are no longer in inventory get deleted from the shelf instead.
+        Only the changed records are touched, not the whole inventory. Inside a transaction() nothing is written until
+        the transaction ends
+        """
+        if not self.dirty_keys or self.undo_log is not None:
+            return 0
+        changed = {}
+        deleted = []
+        for key in self.dirty_keys:
+            if key in self.inventory:
+                changed[key] = self.inventory[key]
+            else:
+                deleted.append(key)
+        self.store.write(changed, deleted, self.id_counters())
+        self.dirty_keys.clear()
+        self.store.sync()
+        if self.lazy:
+            self.inventory.release()
+        written = len(changed) + len(deleted)
+        self.records_written += written
+        self.flush_count += 1
+        return written
+
+    def close(self):
+        """
+        writes any pending changes, saves the snapshot and closes the shelf. Readers of a shared library leave the
+        snapshot to the writer
+        """
+        self.flush()
+        written = self.save_meta() if self.access != "reader" else 0
+        self.store.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+        # the stamp has to be taken now that the shelf is closed, closing it can still touch the files
+        if self.access != "reader":
+            stamp = store_stamp(self.file_name)
+            if written:
+                stamp_snapshot(self.snapshot_file + ".tmp", stamp)
+                os.replace(self.snapshot_file + ".tmp", self.snapshot_file)
+            elif self.snapshot is not None:
+                stamp_snapshot(self.snapshot_file, stamp)
+        # the writer lock is only let go once the snapshot is in place
+        if self.sharing is not None:
+            self.sharing.close()
+
+    def sync_changes(self):
+        """
+        for a reader of a shared library: loads the books the writer has added, edited or deleted since the last call
+        (or since the library was opened) and updates the indexes for just those books. The changes show up in
+        changes_since() like local ones. returns the set of changed IDs, or None if everything had to be reloaded
+        (after the writer emptied the library, or when a change can't be worked out). Does nothing for the writer
+        or a library that isn't shared
+
+        it's load_changes() followed by apply_changes(). worker.LibraryWorker runs the first half, which reads the
+        disk, before it takes its lock, so the pages can keep reading the library in the meantime
+        """
+        return self.apply_changes(self.load_changes())
+
+    def load_changes(self):
+        """
+        the half of sync_changes() that reads the disk. It doesn't change the library, so other threads can keep
+        reading it, as long as nothing changes it before apply_changes() gets what this returned
         """
-        self.shelve_file = shelve.open(file_name)
-        self.inventory = dict(self.shelve_file)
-        self.filtered_inventory = {}
-        self.current_ID = 0
+        if self.access != "reader":
+            return None
+        with self.store.reading():
+            # the writer can't save anything while the lock is held, so the store matches this journal state. The
+            # store's own locks are taken here too, in their usual order, since store.get() takes them again below
+            state = self.sharing.journal.state()
+            changed = self.sharing.journal.read_new()
+            if changed is not None:
+                # the books as they were indexed, the store only has the new versions
+                previous = {}
+                for key in changed:
+                    if key not in self.inventory:
+                        previous[key] = None
+                        continue
+                    previous[key] = self.inventory.known(key) if self.lazy else self.inventory[key]
+                    if previous[key] is None:
+                        # a lazy library that doesn't have the old version in memory any more
+                        changed = None
+                        break
+            if changed is None:
+                return {"state": state, "everything": self.load_everything()}
+            return {"state": state, "previous": previous,
+                    "books": {key: self.store.get(key) for key in sorted(changed)}}
+
+    def apply_changes(self, loaded):
+        """
+        the half of sync_changes() that puts what load_changes() read into the library and its indexes
+        """
+        if loaded is None:
+            return set()
+        if "everything" in loaded:
+            self.reload_all(loaded["everything"])
+            self.store.caught_up(loaded["state"])
+            return None
+        previous = loaded["previous"]
+        for key, book in loaded["books"].items():
+            if previous[key] is not None:
+                self.unindex_book(previous[key])
+            if book is None:
+                if key in self.inventory:
+                    del self.inventory[key]
+                self.filtered_inventory.pop(key, None)
+            else:
+                if self.lazy:
+                    self.inventory.replace(key, book)
+                else:
+                    self.inventory[key] = book
+                if key in self.filtered_inventory:
+                    self.filtered_inventory[key] = book
+                self.index_book(book)
+                if key.isdigit():
+                    self.current_ID = max(self.current_ID, int(key) + 1)
+            self.log_change(key)
+        self.store.caught_up(loaded["state"])
+        if loaded["books"]:
+            print(f"loaded {len(loaded['books'])} books changed by another program")
+        return set(loaded["books"])
+
+    def load_everything(self):
+        # the part of reload_all() that reads the disk: a new inventory, its indexes and the saved ID counters,
+        # without changing the library
+        inventory = self.open_inventory()
+        return inventory, build_indexes(inventory.values()), self.store.load_counters()
+
+    def reload_all(self, loaded=None):
+        """
+        reads every book from the store again and rebuilds the indexes. The version goes up with an empty change_log,
+        so the pages reload everything too
+        loaded: what load_everything() returned, if the books were already read
+        """
+        if loaded is None:
+            self.store.reopen()
+            loaded = self.load_everything()
+        self.inventory, indexes, counters = loaded
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        self.filtered_inventory = self.subset()
+        self.filtered_stats = StatsAggregator()
+        self.current_ID = max((int(i) for i in self.inventory if i.isdigit()), default=-1) + 1
+        self.set_counters(counters)
+        self.genre_index, self.text_index, self.year_index, self.cost_index, self.stats = indexes
+        self.version += 1
+        self.change_log = []
+        print(f"reloaded all {len(self.inventory)} books")
+
+    def enable_metrics(self, slow_ms=100, dump_file=None, dump_every=60):
+        """
+        starts timing every public function and counting the records it reads and writes, see metrics.py.
+        slow_ms: calls slower than this are printed
+        dump_file: if given, the numbers are saved there as JSON every dump_every seconds and on close()
+        returns the LibraryMetrics, whose snapshot() gives the numbers so far
+        """
+        if self.metrics is None:
+            from metrics import LibraryMetrics
+            self.metrics = LibraryMetrics(self, slow_ms, dump_file, dump_every)
+        return self.metrics
+
+    @contextmanager
+    def transaction(self):
+        """
+        groups changes so they are saved together, or not at all:
+
+            with library.transaction():
+                library.delete_book(3)
+                library.edit_book(4, cost=20)
+
+        adds, edits and deletes inside the block change the inventory, indexes and stats like normal, but nothing
+        is written to the shelf until the block ends, and then it's all written in one flush. If the block raises an
+        exception, every book it touched is put back the way it was (along with the indexes, stats, ID counter and
+        version) and the exception is passed on. A transaction inside another one just becomes part of the outer one
+
+        the same happens if that flush fails, and the books stay dirty so the next flush writes them back the way they
+        were. The store saves the flush all at once (see ShelveBackend.write()), so a program that stops part way
+        through it doesn't leave half a transaction behind. With autoflush off, the flush is left to the caller
+        """
+        if self.undo_log is not None:
+            yield self
+            return
+
+        current_ID = self.current_ID
+        free_IDs = list(self.free_IDs)
+        version = self.version
+        dirty_keys = set(self.dirty_keys)
+        self.undo_log = {}
+        try:
+            yield self
+        except BaseException:
+            self.rollback(current_ID, free_IDs, version, dirty_keys)
+            raise
+        undo_log, self.undo_log = self.undo_log, None
+        if self.autoflush:
+            try:
+                self.flush()
+            except BaseException:
+                # some of the books might have been written before it failed
+                self.undo_log = undo_log
+                self.rollback(current_ID, free_IDs, version, dirty_keys | set(undo_log))
+                raise
+
+    def remember(self, book_id):
+        # inside a transaction, saves how a book looked before its first change so rollback() can restore it
+        key = str(book_id)
+        if self.undo_log is None or key in self.undo_log:
+            return
+        book = self.inventory.get(key)
+        self.undo_log[key] = (copy.copy(book) if book is not None else None, key in self.filtered_inventory)
+
+    def rollback(self, current_ID, free_IDs, version, dirty_keys):
+        """
+        undoes every change made during the current transaction, using undo_log
+        """
+        for key, (original, filtered) in self.undo_log.items():
+            book = self.inventory.pop(key, None)
+            if book is not None:
+                self.unindex_book(book)
+            self.filtered_inventory.pop(key, None)
+            if original is not None:
+                self.inventory[key] = original
+                if filtered:
+                    self.filtered_inventory[key] = original
+                self.index_book(original)
+        self.undo_log = None
+        self.current_ID = current_ID
+        self.free_IDs = free_IDs
+        self.version = version
+        while self.change_log and self.change_log[-1][0] > version:
+            self.change_log.pop()
+        self.dirty_keys = dirty_keys
+        if self.lazy and not self.dirty_keys:
+            # the restored books match the store again, so they don't have to stay in memory
+            self.inventory.release()
+        print("transaction rolled back")
+
+    def next_free_ID(self):
+        """
+        hands out an ID for a new book. A deleted ID is reused first if reuse_IDs is on, otherwise the high-water mark
+        goes up by one. The checks against inventory are only there in case the saved counter was out of date
+        """
+        while self.free_IDs:
+            book_id = self.free_IDs.pop()
+            if str(book_id) not in self.inventory:
+                return book_id
+        while str(self.current_ID) in self.inventory:
+            self.current_ID += 1
+        book_id = self.current_ID
+        self.current_ID += 1
+        return book_id
 
     def add_book(self, name, author, publish, cost, genre_tags=()):
-        # finds next free ID
-        if str(self.current_ID) in self.shelve_file:
-            while str(self.current_ID) in self.shelve_file:
-                self.current_ID += 1
-        new_book = Book(name, author, publish, cost, self.current_ID, genre_tags)
-        self.inventory[str(self.current_ID)] = new_book
-        self.shelve_file.update(self.inventory)
+        self.check_writable()
+        book_id = self.next_free_ID()
+        new_book = Book(name, author, publish, cost, book_id, genre_tags)
+        self.remember(book_id)
+        self.inventory[str(book_id)] = new_book
+        self.index_book(new_book)
+        self.mark_dirty(book_id)
         print(f"{new_book}. has been added to library")
+        return book_id
+
+    def import_books(self, source, format=None):
+        """
+        adds many books at once and writes them to the shelf in a single flush. It runs as one transaction(), so an
+        unexpected error (like the file going away halfway through) rolls back every book it added
+
+        source: a path to a .csv or .jsonl file, or any iterable of dicts (one dict per book)
+        format: "csv" or "jsonl". Only needed when it can't be guessed from the file extension
+
+        rows are streamed one at a time so the file never has to fit in memory. A row needs at least a name and an
+        author, and publish_date/cost have to be numbers if they are given. Rows that fail are skipped and reported.
+        returns a dictionary with how many books were imported, the rejected rows (as (row number, reason) pairs),
+        how long it took and the throughput in rows per second
+        """
+        self.check_writable()
+        start = time.perf_counter()
+        new_books = []
+        rejected = []
+        with self.transaction():
+            try:
+                for row_number, row in enumerate(read_book_rows(source, format), start=1):
+                    try:
+                        name, author, publish, cost, genre_tags = parse_book_row(row)
+                    except ValueError as error:
+                        rejected.append((row_number, str(error)))
+                        continue
+                    book_id = self.next_free_ID()
+                    new_book = Book(name, author, publish, cost, book_id, genre_tags)
+                    self.remember(book_id)
+                    self.inventory[str(book_id)] = new_book
+                    self.mark_dirty(book_id)
+                    new_books.append(new_book)
+            finally:
+                # the books are indexed in one batch. This also runs if something goes wrong, so a rollback finds
+                # them in the indexes like every other book it takes out
+                self.index_books(new_books)
+        # written even if autoflush is off, the import is meant to be saved in one go
+        self.flush()
+        imported = len(new_books)
+        seconds = time.perf_counter() - start
+        report = {
+            "imported": imported,
+            "rejected": rejected,
+            "seconds": seconds,
+            "rows_per_second": (imported + len(rejected)) / seconds if seconds else 0.0
+        }
+        print(f"imported {imported} books ({len(rejected)} rejected) in {seconds:.2f}s, "
+              f"{report['rows_per_second']:.0f} rows/s")
+        return report
 
     def delete_book(self, book_id):
+        self.check_writable()
+        key = str(book_id)
+        if key not in self.inventory:
+            print("delete attempt failed")
+            return False
+        book = self.inventory[key]
+        self.remember(key)
         try:
-            del self.shelve_file[str(book_id)]
-            del self.inventory[str(book_id)]
-            print(f"deleted book {book_id}")
-            return True
+            self.unindex_book(book)
         except:
+            # the book is still in inventory, so the indexes can be put right by building them again
+            self.repair_indexes()
             print("delete attempt failed")
             return False
+        del self.inventory[key]
+        self.filtered_inventory.pop(key, None)
+        # before mark_dirty(), so the flush saves the freed ID with the deletion
+        if self.reuse_IDs:
+            self.free_IDs.append(int(book_id))
+        self.mark_dirty(book_id)
+        print(f"deleted book {book_id}")
+        return True
+
+    def delete_books(self, book_ids):
+        """
+        deletes many books at once, in one transaction and one write. IDs that aren't in the library are skipped.
+        returns how many books were deleted
+        """
+        self.check_writable()
+        books = []
+        with self.transaction():
+            try:
+                for book_id in book_ids:
+                    key = str(book_id)
+                    if key not in self.inventory:
+                        continue
+                    self.remember(key)
+                    book = self.inventory.pop(key)
+                    self.genre_index.remove(book)
+                    self.text_index.remove(book)
+                    self.stats.remove(book)
+                    if key in self.filtered_inventory:
+                        del self.filtered_inventory[key]
+                        self.filtered_stats.remove(book)
+                    self.mark_dirty(key)
+                    if self.reuse_IDs:
+                        self.free_IDs.append(int(key))
+                    books.append(book)
+            finally:
+                # the sorted indexes get one pass for the whole batch instead of one list deletion per book. This also
+                # runs if something goes wrong, so a rollback finds them matching the other indexes
+                self.year_index.remove_many(books)
+                self.cost_index.remove_many(books)
+        print(f"deleted {len(books)} books")
+        return len(books)
 
     def print_books(self):
         # prints all books out, use for debugging
-        for i in dict(self.shelve_file):
-            print(f'{dict(self.shelve_file)[i]}')
+        for book in self.iter_books():
+            print(f'{book}')
+
+    def iter_books(self, use_filter=False):
+        """
+        generator that yields every book (or every filtered book if use_filter is True) in ID order, one at a time,
+        without copying the inventory. Books deleted while it's running are skipped
+        """
+        books = self.filtered_inventory if use_filter else self.inventory
+        for key in sorted(books, key=lambda key: int(key) if key.isdigit() else -1):
+            book = books.get(key)
+            if book is not None:
+                yield book
+
+    # the columns written by export(), the same names import_books() reads
+    EXPORT_FIELDS = ("ID", "name", "author", "publish_date", "cost", "genre_tags")
+
+    def export(self, path, format=None, filter=None, use_filter=False, chunk_size=1000):
+        """
+        writes the books to a .csv or .jsonl file that import_books() can read back
+
+        format: "csv" or "jsonl". Only needed when it can't be guessed from the file extension
+        filter: optional function that gets a book and returns True if it should be exported
+        use_filter: export the filtered books (from apply_filter()) instead of every book
+
+        the books are streamed in ID order and written chunk_size at a time, so only one chunk is ever held in memory.
+        The file is written under a temporary name and renamed at the end, so a half written export never replaces
+        an old one. returns how many books were exported
+        """
+        if format is None:
+            format = os.path.splitext(str(path))[1].lstrip(".").lower()
+        if format not in ("csv", "jsonl", "json"):
+            raise ValueError(f"unknown export format: {format}")
+
+        temporary = str(path) + ".tmp"
+        exported = 0
+        try:
+            with open(temporary, "w", newline="", encoding="utf-8") as file:
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                if format == "csv":
+                    writer.writerow(self.EXPORT_FIELDS)
+                for book in self.iter_books(use_filter):
+                    if filter is not None and not filter(book):
+                        continue
+                    if format == "csv":
+                        # csv keeps all the tags in one column (see join_tags(), import_books() reads it back)
+                        tags = book.genre_tags if isinstance(book.genre_tags, str) else join_tags(book.genre_tags)
+                        writer.writerow((book.ID, book.name, book.author, book.publish_date, book.cost, tags))
+                    else:
+                        buffer.write(json.dumps(book.get_stats()) + "\n")
+                    exported += 1
+                    if exported % chunk_size == 0:
+                        file.write(buffer.getvalue())
+                        buffer.seek(0)
+                        buffer.truncate()
+                file.write(buffer.getvalue())
+            os.replace(temporary, path)
+        except:
+            # don't leave a half written file behind
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        print(f"exported {exported} books to {path}")
+        return exported
 
     def print_filtered_books(self):
         for i in self.filtered_inventory:
-            print(f'{dict(self.shelve_file)[i]}')
+            print(f'{self.filtered_inventory[i]}')
 
     def edit_book(self, book_id, name=False, author=False, publish_date=False, cost=False, genre=False):
-        # edits a book
-        if str(book_id) not in dict(self.shelve_file):
+        # edits a book. Fields left at False stay the same, anything else is set, even a cost of 0 or no genres
+        self.check_writable()
+        if str(book_id) not in self.inventory:
             print("edit attempt failed, book not found in library")
             return False
-        if name:
-            self.inventory[str(book_id)].name = name
-        if author:
-            self.inventory[str(book_id)].author = author
-        if publish_date:
-            self.inventory[str(book_id)].publish_date = publish_date
-        if cost:
-            self.inventory[str(book_id)].cost = cost
-        if genre:
-            self.inventory[str(book_id)].genre_tags = genre
-        self.shelve_file.update(self.inventory)
+        book = self.inventory[str(book_id)]
+        self.remember(book_id)
+        original = copy.copy(book)
+        try:
+            self.unindex_book(book)
+            if name is not False:
+                book.name = intern_text(name)
+            if author is not False:
+                book.author = intern_text(author)
+            if publish_date is not False:
+                book.publish_date = publish_date
+            if cost is not False:
+                book.cost = cost
+            if genre is not False:
+                book.genre_tags = [intern_text(i) for i in genre] if isinstance(genre, list) else genre
+            self.index_book(book)
+        except:
+            # a bad value (like genre tags that can't be indexed), put the book back. The indexes could have stopped
+            # part way through, so they're built again to be sure they match
+            for i in Book.__slots__:
+                setattr(book, i, getattr(original, i))
+            self.repair_indexes()
+            raise
+        self.mark_dirty(book_id)
 
-    def apply_filter(self, name=False, author=False, publish=False, cost=False, genre_tags=False):
+    def apply_filter(self, name=False, author=False, publish=False, cost=False, genre_tags=False,
+                     year_between=None, year_min=None, year_max=None,
+                     cost_between=None, cost_min=None, cost_max=None):
         """
         filters are used for searching
         name filter: finds all books that include a certain substring
@@ -113,25 +1023,80 @@ class Library:
         publish: finds books with matching publish dates
         cost: finds books with matching costs
         genre_tags: finds books with at least 1 matching genre tags
+        year_between, cost_between: a (low, high) pair, finds books with low <= value <= high
+        year_min, year_max, cost_min, cost_max: one-sided versions of the ranges above
 
-        a book must pass all 6 filters to be eligible, although certain filters can be left
+        a book must pass all the filters to be eligible, although certain filters can be left. That includes the
+        bounds on one field, so publish=1997, year_max=1950 finds nothing
+
+        the filters are answered from the indexes, so only books that already match those get looked at. Years and
+        costs are compared as numbers, so "1997" matches 1997. A range bound that isn't a number raises ValueError
+        """
+        matched = self.match_filter(name, author, publish, cost, genre_tags, year_between, year_min, year_max,
+                                    cost_between, cost_min, cost_max)
+        if matched is None:
+            # no filters at all, every book passes and the totals are the same as stats
+            self.filtered_inventory = self.subset(self.inventory)
+            self.filtered_stats = copy.deepcopy(self.stats)
+            return
+        self.filtered_inventory = self.subset()
+        self.filtered_stats = StatsAggregator()
+        for i in matched:
+            self.filtered_inventory[i] = self.inventory[i]
+            self.filtered_stats.add(self.inventory[i])
+
+    def match_filter(self, name=False, author=False, publish=False, cost=False, genre_tags=False,
+                     year_between=None, year_min=None, year_max=None,
+                     cost_between=None, cost_min=None, cost_max=None):
         """
-        self.inventory = dict(self.shelve_file)
-        self.filtered_inventory = {}
-        for i in self.inventory:
+        finds the books for apply_filter() (it takes the same filters) without changing filtered_inventory, so it's
+        safe to call from several threads at once. returns a list of the IDs that pass, or None if no filter was
+        given and every book does
+        """
+        pools = []
+        for index, exact, between, low, high in ((self.year_index, publish, year_between, year_min, year_max),
+                                                 (self.cost_index, cost, cost_between, cost_min, cost_max)):
+            low, high = combine_bounds(index.field, exact, between, low, high)
+            if low is not None or high is not None:
+                pools.append(index.range(low, high))
+        if name:
+            pools.append(self.text_index.search(name, fields=("name",)))
+        if author:
+            pools.append(self.text_index.search(author, fields=("author",)))
+        if genre_tags:
+            if isinstance(genre_tags, str):
+                genre_tags = [genre_tags]
+            pools.append(self.genre_index.lookup(genre_tags))
+        if pools:
+            pools.sort(key=len)
+            pool = sorted(pools[0].intersection(*pools[1:]), key=int)
+        elif not publish and not cost:
+            return None
+        else:
+            pool = self.inventory
+        matched = []
+        for i in pool:
             valid = True
-            if name and not (name.lower() in self.inventory[i].name.lower()):
-                valid = False
-            if author and not (author.lower() in self.inventory[i].author.lower()):
-                valid = False
-            if publish and not (publish == self.inventory[i].publish_date):
+            # a publish date or cost that isn't a number can't use the indexes, so compare it the old way
+            if publish and to_number(publish) is None and not (publish == self.inventory[i].publish_date):
                 valid = False
-            if cost and not (cost == self.inventory[i].cost):
-                valid = False
-            if genre_tags and not (len(list(set(genre_tags + self.inventory[i].genre_tags))) < len(genre_tags) + len(self.inventory[i].genre_tags)):
+            if cost and to_number(cost) is None and not (cost == self.inventory[i].cost):
                 valid = False
             if valid:
-                self.filtered_inventory[i] = self.inventory[i]
+                matched.append(i)
+        return matched
+
+    def search(self, text, fields=("name", "author"), prefix=False, within=None):
+        """
+        finds every book where any of the given fields contains text, ignoring case. fields can be any of "name",
+        "author", "genre_tags", "publish_date" and "cost" (so "199" finds the books from the 1990s). With
+        prefix=True, the field has to start with text instead. within can be a list of IDs to narrow down (like the
+        results of the previous, shorter search) instead of the whole catalog
+
+        returns a dictionary of ID -> book (like inventory), in ID order
+        """
+        found = self.text_index.search(text, fields, prefix, within)
+        return self.subset(sorted(found, key=int))
 
     def stats_tags(self, use_filter=False):
         """
@@ -139,21 +1104,12 @@ class Library:
         genre tag appears
 
         by default, this searches through inventory (every book kept in this library), setting use_filter to True makes
-        it search through the filtered inventory instead
+        it search through the filtered inventory instead. The counts are kept up to date as books change, so nothing
+        gets recounted here
         """
-        tags = {}
         if use_filter:
-            pool = self.filtered_inventory
-        else:
-            pool = self.inventory
-
-        for i in pool:
-            for j in pool[i].genre_tags:
-                if j not in tags:
-                    tags[j] = 1
-                else:
-                    tags[j] += 1
-        return tags
+            return dict(self.filtered_stats.genres)
+        return dict(self.stats.genres)
 
     def stats_books(self, use_filter=False):
         """
@@ -163,18 +1119,37 @@ class Library:
         by default, this searches through inventory (every book kept in this library), setting use_filter to True makes
         it search through the filtered inventory instead
         """
-        books = {}
         if use_filter:
-            pool = self.filtered_inventory
-        else:
-            pool = self.inventory
+            return dict(self.filtered_stats.titles)
+        return dict(self.stats.titles)
 
-        for i in pool:
-            if pool[i].name not in books:
-                books[pool[i].name] = 1
-            else:
-                books[pool[i].name] += 1
-        return books
+    def stats_genre_costs(self, use_filter=False):
+        """
+        returns a dictionary with the keys being genre tags and the contents being a dictionary with the "count", "sum",
+        "min" and "max" of the costs of the books in that genre (books without a numeric cost are left out)
+
+        by default, this searches through inventory (every book kept in this library), setting use_filter to True makes
+        it search through the filtered inventory instead
+        """
+        if use_filter:
+            return self.filtered_stats.cost_summary()
+        return self.stats.cost_summary()
+
+    def book_ids(self, use_filter=False):
+        """
+        returns a list of the IDs of every book (or every filtered book if use_filter is True), without loading or
+        copying the books themselves
+        """
+        if use_filter:
+            return list(self.filtered_inventory)
+        return list(self.inventory)
+
+    def get_books(self, ids):
+        """
+        returns a dictionary of ID -> book for just the given IDs, skipping any that don't exist. This is how the
+        inventory page fetches the rows it's about to show
+        """
+        return {str(i): self.inventory[str(i)] for i in ids if str(i) in self.inventory}
 
     def stats_inventory(self, use_filter=False):
         """
@@ -203,20 +1178,40 @@ class Library:
         """
         creates a small sample of books based on wikipedia's all-time best-selling books section
         """
-        self.add_book("A Tale of Two Cities", "Charles Dickens", 1859, 200, ["historical fiction"])
-        self.add_book("The Little Prince", "Antoine de Saint-Exupery", 1943, 200, ["fantasy"])
-        self.add_book("The Alchemist", "Paulo Coelho", 1988, 150, ["fantasy"])
-        self.add_book("Harry Potter and the Philosopher's Stone", "J. K. Rowling", 1997, 120, ["fantasy"])
-        self.add_book("And Then There Were None", "Agatha Christie", 1939, 100, ["mystery"])
-        self.add_book("Dream of the Red Chamber", "Cao Xueqin", 1791, 100, ["family saga"])
-        self.add_book("The Hobbit", "J. R. R. Tolkien", 1937, 100, ["fantasy", "children's fiction"])
-        self.add_book("Alice's Adventures in Wonderland", "Lewis Carroll", 1865, 100, ["fantasy", "absurdist fiction"])
+        with self.transaction():
+            self.add_book("A Tale of Two Cities", "Charles Dickens", 1859, 200, ["historical fiction"])
+            self.add_book("The Little Prince", "Antoine de Saint-Exupery", 1943, 200, ["fantasy"])
+            self.add_book("The Alchemist", "Paulo Coelho", 1988, 150, ["fantasy"])
+            self.add_book("Harry Potter and the Philosopher's Stone", "J. K. Rowling", 1997, 120, ["fantasy"])
+            self.add_book("And Then There Were None", "Agatha Christie", 1939, 100, ["mystery"])
+            self.add_book("Dream of the Red Chamber", "Cao Xueqin", 1791, 100, ["family saga"])
+            self.add_book("The Hobbit", "J. R. R. Tolkien", 1937, 100, ["fantasy", "children's fiction"])
+            self.add_book("Alice's Adventures in Wonderland", "Lewis Carroll", 1865, 100, ["fantasy", "absurdist fiction"])
 
     def delete_all_books(self):
         """
-        deletes all books
+        deletes all books. The whole store is emptied at once and the indexes start over, instead of deleting the
+        books one at a time. Inside a transaction it deletes them like delete_books() so it can still be rolled back
         """
-        temp = dict(self.inventory)
-        for i in temp:
-            self.delete_book(i)
+        self.check_writable()
+        if self.undo_log is not None:
+            return self.delete_books(list(self.inventory))
+        count = len(self.inventory)
+        self.store.clear()
+        self.inventory = self.open_inventory()
+        self.filtered_inventory = self.subset()
+        self.dirty_keys.clear()
+        self.rebuild_indexes()
+        self.filtered_stats = StatsAggregator()
+        if self.reuse_IDs:
+            # every ID is free again, so start counting from the beginning
+            self.current_ID = 0
+            self.free_IDs = []
+        self.store.write({}, (), self.id_counters())
+        self.store.sync()
+        # an empty change_log makes changes_since() tell the pages to reload everything
+        self.version += 1
+        self.change_log = []
+        print(f"deleted all {count} books")
+        return count
 
@@ -0,0 +1,305 @@
+import bisect
+import math
+
+
+class GenreIndex:
+    """
+    an inverted index from each genre tag to the set of IDs (as strings, same as the inventory keys) of the books
+    that have that tag. Library keeps it up to date on every add, edit and delete
+    """
+    def __init__(self, tags=None):
+        """
+        tags: a dictionary of genre tag -> set of book IDs, used when loading a saved index
+        """
+        self.tags = tags if tags is not None else {}
+
+    def add(self, book):
+        for tag in book.genre_tags:
+            self.tags.setdefault(tag, set()).add(str(book.ID))
+
+    def remove(self, book):
+        for tag in book.genre_tags:
+            ids = self.tags.get(tag)
+            if ids is None:
+                continue
+            ids.discard(str(book.ID))
+            # drop tags nobody uses anymore so they stop showing up in the stats
+            if not ids:
+                del self.tags[tag]
+
+    def lookup(self, genre_tags):
+        """
+        returns the IDs of every book that has at least one of the given tags
+        """
+        found = set()
+        for tag in genre_tags:
+            found |= self.tags.get(tag, set())
+        return found
+
+
+def normalize_text(text):
+    # lower-cases the text and squashes runs of whitespace, so searches don't care about either
+    return " ".join(str(text).casefold().split())
+
+
+def trigrams(text):
+    """
+    returns the set of 3-character pieces of a normalized string
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TextIndex:
+    """
+    a trigram index over the title, author, genres, year and cost of every book, used for substring and prefix
+    searches. Years and costs are indexed as they're written, so "199" finds 1997 like the old search box did
+
+    each field has its own posting lists (trigram -> set of book IDs). A search looks up the trigrams of the query,
+    intersects their posting lists starting from the smallest, and then double checks the few books that are left,
+    so a search never has to look at the whole catalog. Queries shorter than a trigram fall back to a plain scan
+    """
+    FIELDS = ("name", "author", "genre_tags", "publish_date", "cost")
+
+    # put in front of every value so that trigrams touching the start of a value can be told apart, this is what
+    # makes prefix searches work
+    START = "\x02"
+
+    def __init__(self, postings=None, values=None):
+        """
+        postings: field -> {trigram: set of book IDs}
+        values: field -> {book ID: normalized value}, kept so matches can be checked without going back to the books
+        """
+        self.postings = postings if postings is not None else {field: {} for field in self.FIELDS}
+        self.values = values if values is not None else {field: {} for field in self.FIELDS}
+
+    @staticmethod
+    def field_value(book, field):
+        value = getattr(book, field)
+        if field == "genre_tags" and not isinstance(value, str):
+            value = " ".join(value)
+        return normalize_text(value)
+
+    def add(self, book):
+        book_id = str(book.ID)
+        for field in self.FIELDS:
+            value = self.field_value(book, field)
+            self.values[field][book_id] = value
+            postings = self.postings[field]
+            for gram in trigrams(self.START + value):
+                postings.setdefault(gram, set()).add(book_id)
+
+    def remove(self, book):
+        book_id = str(book.ID)
+        for field in self.FIELDS:
+            value = self.values[field].pop(book_id, None)
+            if value is None:
+                continue
+            postings = self.postings[field]
+            for gram in trigrams(self.START + value):
+                ids = postings.get(gram)
+                if ids is None:
+                    continue
+                ids.discard(book_id)
+                if not ids:
+                    del postings[gram]
+
+    def search(self, text, fields=("name", "author"), prefix=False, within=None):
+        """
+        returns the set of IDs of books where any of the given fields contains text (or starts with it if prefix
+        is True). Matching ignores case
+
+        within: optional IDs to search inside of, e.g. the results of a shorter query that this one extends. If
+                there are fewer of them than the smallest posting list, they are checked directly instead
+        """
+        query = normalize_text(text)
+        found = set()
+        for field in fields:
+            values = self.values[field]
+            grams = trigrams(self.START + query if prefix else query)
+            postings = self.postings[field]
+            lists = sorted((postings.get(gram, set()) for gram in grams), key=len)
+
+            if within is not None and (not lists or len(within) <= len(lists[0])):
+                candidates = [i for i in within if i in values]
+            elif not lists:
+                # too short to have a trigram, so just check every value
+                candidates = values
+            else:
+                candidates = set(lists[0])
+                for ids in lists[1:]:
+                    if not candidates:
+                        break
+                    candidates &= ids
+                if within is not None:
+                    candidates &= set(within)
+
+            # having every trigram doesn't always mean the whole query is there, so check what's left
+            if prefix:
+                found |= {i for i in candidates if values[i].startswith(query)}
+            else:
+                found |= {i for i in candidates if query in values[i]}
+        return found
+
+
+def to_number(value):
+    """
+    turns a year or a cost into a number, so "1997" (typed into the add book page) and 1997 (from create_sample)
+    compare the same. Returns None if the value isn't a number, NaN included: it isn't equal to anything (not even
+    itself), so it would break the sorted indexes and can't be a dictionary key in the stats
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, float):
+        try:
+            value = float(str(value).strip().lstrip("$"))
+        except ValueError:
+            return None
+    return None if math.isnan(value) else value
+
+
+class SortedIndex:
+    """
+    a sorted list of (number, book ID) pairs for one numeric field (publish_date or cost), used for range queries
+
+    finding the start and end of a range is a binary search, so a query costs O(log n + k) where k is the number
+    of books in the range. Books whose value isn't a number are left out of the index
+    """
+    def __init__(self, field, entries=None):
+        """
+        field: the Book attribute this index is built on
+        entries: a sorted list of (number, int ID) pairs, used when loading a saved index. It can also be a read-only
+                sequence (like snapshot.PairColumns), which is copied into a list the first time the index changes
+        """
+        self.field = field
+        self.entries = entries if entries is not None else []
+
+    def writable(self):
+        if not isinstance(self.entries, list):
+            self.entries = list(self.entries)
+
+    def add(self, book):
+        number = to_number(getattr(book, self.field))
+        if number is not None:
+            self.writable()
+            bisect.insort(self.entries, (number, int(book.ID)))
+
+    def append(self, book):
+        # adds a book at the end without keeping entries sorted, call sort() once the whole batch is in
+        number = to_number(getattr(book, self.field))
+        if number is not None:
+            self.writable()
+            self.entries.append((number, int(book.ID)))
+
+    def sort(self):
+        self.writable()
+        self.entries.sort()
+
+    def remove(self, book):
+        number = to_number(getattr(book, self.field))
+        if number is None:
+            return
+        position = bisect.bisect_left(self.entries, (number, int(book.ID)))
+        if position < len(self.entries) and self.entries[position] == (number, int(book.ID)):
+            self.writable()
+            del self.entries[position]
+
+    def remove_many(self, books):
+        """
+        removes a batch of books in one pass over the entries, instead of one list deletion per book
+        """
+        ids = {int(book.ID) for book in books}
+        self.entries = [entry for entry in self.entries if entry[1] not in ids]
+
+    def range(self, low=None, high=None):
+        """
+        returns the IDs (as strings) of books with low <= value <= high. Either end can be None to leave it open
+        """
+        start = 0 if low is None else bisect.bisect_left(self.entries, (to_number(low), -math.inf))
+        end = len(self.entries) if high is None else bisect.bisect_right(self.entries, (to_number(high), math.inf))
+        return {str(book_id) for number, book_id in self.entries[start:end]}
+
+
+class StatsAggregator:
+    """
+    running totals for the statistics page, updated one book at a time so reading them never needs a full scan
+
+    book_count: how many books have been added
+    titles: book title -> how many copies of it there are
+    genres: genre tag -> how many books have it
+    genre_costs: genre tag -> {cost: how many books in that genre have that cost}, kept so the min and max can be
+            found again when the cheapest or most expensive book is removed
+    genre_cost_counts: genre tag -> how many books in that genre have a numeric cost
+    genre_cost_sums: genre tag -> total cost of the books in that genre
+    genre_cost_min, genre_cost_max: genre tag -> cheapest / most expensive cost in that genre
+    """
+    def __init__(self):
+        self.book_count = 0
+        self.titles = {}
+        self.genres = {}
+        self.genre_costs = {}
+        self.genre_cost_counts = {}
+        self.genre_cost_sums = {}
+        self.genre_cost_min = {}
+        self.genre_cost_max = {}
+
+    def add(self, book):
+        self.book_count += 1
+        self.titles[book.name] = self.titles.get(book.name, 0) + 1
+        cost = to_number(book.cost)
+        for tag in book.genre_tags:
+            self.genres[tag] = self.genres.get(tag, 0) + 1
+            if cost is None:
+                continue
+            costs = self.genre_costs.setdefault(tag, {})
+            costs[cost] = costs.get(cost, 0) + 1
+            self.genre_cost_counts[tag] = self.genre_cost_counts.get(tag, 0) + 1
+            self.genre_cost_sums[tag] = self.genre_cost_sums.get(tag, 0) + cost
+            if tag not in self.genre_cost_min or cost < self.genre_cost_min[tag]:
+                self.genre_cost_min[tag] = cost
+            if tag not in self.genre_cost_max or cost > self.genre_cost_max[tag]:
+                self.genre_cost_max[tag] = cost
+
+    def remove(self, book):
+        self.book_count -= 1
+        decrement(self.titles, book.name)
+        cost = to_number(book.cost)
+        for tag in book.genre_tags:
+            decrement(self.genres, tag)
+            if cost is None or tag not in self.genre_costs:
+                continue
+            costs = self.genre_costs[tag]
+            decrement(costs, cost)
+            decrement(self.genre_cost_counts, tag)
+            self.genre_cost_sums[tag] -= cost
+            if not costs:
+                del self.genre_costs[tag], self.genre_cost_sums[tag]
+                del self.genre_cost_min[tag], self.genre_cost_max[tag]
+                continue
+            # only look through the costs again if the book we removed was the last one at the min or max
+            if cost == self.genre_cost_min[tag] and cost not in costs:
+                self.genre_cost_min[tag] = min(costs)
+            if cost == self.genre_cost_max[tag] and cost not in costs:
+                self.genre_cost_max[tag] = max(costs)
+
+    def cost_summary(self):
+        """
+        returns genre tag -> {"count", "sum", "min", "max"} for the books in that genre that have a numeric cost
+        """
+        summary = {}
+        for tag, count in self.genre_cost_counts.items():
+            summary[tag] = {
+                "count": count,
+                "sum": self.genre_cost_sums[tag],
+                "min": self.genre_cost_min[tag],
+                "max": self.genre_cost_max[tag]
+            }
+        return summary
+
+
+def decrement(counts, key):
+    # lowers a count by one and forgets the key once it reaches zero
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
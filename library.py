@@ -0,0 +1,26 @@
+import argparse
+import sys
+
+from sharing import LibraryLockedError
+
+
+# command line for the library without the Tk window
+#   python -m library serve --port 8080      serves the catalog over HTTP, see server.py
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m library", description="Library inventory tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="serve the library as a JSON HTTP API")
+    serve_parser.add_argument("--file", default="books", help="the shelf to serve (books by default, like main.py)")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--backend", choices=("shelve", "sqlite"), default="shelve")
+    serve_parser.add_argument("--quiet", action="store_true", help="don't print a line for every change")
+    arguments = parser.parse_args()
+
+    if arguments.command == "serve":
+        from server import serve
+        try:
+            serve(arguments.file, arguments.host, arguments.port, arguments.backend, arguments.quiet)
+        except LibraryLockedError as error:
+            sys.exit(f"can't serve: {error}")
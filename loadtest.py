@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import WORDS, GENRES, make_rows, summarize
+
+
+# load test for the HTTP server (server.py). Opens a number of keep-alive connections and sends a mix of requests
+# for a fixed time, then prints requests per second and latency percentiles for each kind of request
+#   python loadtest.py --spawn 10000                     builds a 10000 book library and serves it just for the test
+#   python loadtest.py --port 8080 --connections 32      tests a server that's already running
+
+# how often each kind of request is sent, out of the total
+MIX = {"search": 40, "filter": 10, "stats": 25, "get": 15, "add": 4, "edit": 4, "delete": 2}
+
+
+def make_request(kind, rng, ids):
+    """
+    returns (method, path, body) for one request of the given kind
+    """
+    if kind == "search":
+        return "GET", f"/search?q={rng.choice(WORDS)}&limit=20", None
+    if kind == "filter":
+        low = rng.randint(1700, 2000)
+        return "GET", f"/filter?genre={rng.choice(GENRES).replace(' ', '+')}&year_min={low}&year_max={low + 24}" \
+                      f"&limit=20", None
+    if kind == "stats":
+        return "GET", rng.choice(("/stats", "/stats/tags", "/stats/genre_costs")), None
+    if kind == "add":
+        return "POST", "/books", {"name": f"Load test {rng.random():.6f}", "author": "Load Tester",
+                                  "publish_date": rng.randint(1700, 2024), "cost": rng.randint(5, 300),
+                                  "genre_tags": [rng.choice(GENRES)]}
+    book_id = rng.choice(ids) if ids else 0
+    if kind == "edit":
+        return "PATCH", f"/books/{book_id}", {"cost": rng.randint(5, 300)}
+    if kind == "delete":
+        return "DELETE", f"/books/{book_id}", None
+    return "GET", f"/books/{book_id}", None
+
+
+async def send(reader, writer, host, method, path, body):
+    # one request over an open connection, returns (status, parsed body)
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(host, port, deadline, rng, ids, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    kinds, weights = zip(*MIX.items())
+    try:
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            method, path, body = make_request(kind, rng, ids)
+            start = time.perf_counter()
+            status, answer = await send(reader, writer, host, method, path, body)
+            latencies[kind].append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if kind == "add" and status == 201:
+                ids.append(answer["ID"])
+            elif kind == "delete" and status == 200:
+                # deleted books aren't picked again (404s are still possible if two clients race for one)
+                with contextlib.suppress(ValueError):
+                    ids.remove(int(answer["deleted"]))
+    finally:
+        writer.close()
+
+
+async def run(host, port, connections, duration, seed=0):
+    """
+    runs the load test against host:port, returns the report as a dictionary
+    """
+    rng = random.Random(seed)
+    # the IDs to read, edit and delete. The server's IDs are 0 up to the book count (made by --spawn or not)
+    reader, writer = await asyncio.open_connection(host, port)
+    status, stats = await send(reader, writer, host, "GET", "/stats", None)
+    writer.close()
+    ids = list(range(stats["book_count"]))
+
+    latencies = {kind: [] for kind in MIX}
+    statuses = {}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(client(host, port, deadline, random.Random(rng.random()), ids, latencies, statuses)
+                           for i in range(connections)))
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(calls) for calls in latencies.values())
+    return {
+        "connections": connections,
+        "seconds": elapsed,
+        "requests": total,
+        "requests_per_second": total / elapsed,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "kinds": {kind: summarize(calls) for kind, calls in latencies.items() if calls}
+    }
+
+
+def print_report(report):
+    print(f"\n{report['requests']} requests over {report['connections']} connections in {report['seconds']:.1f}s: "
+          f"{report['requests_per_second']:.0f} requests/s")
+    print(f"statuses: {report['statuses']}")
+    print(f"{'request':<10}{'calls':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, summary in report["kinds"].items():
+        print(f"{kind:<10}{summary['calls']:>8}{summary['p50_ms']:>10.3f}{summary['p90_ms']:>10.3f}"
+              f"{summary['p99_ms']:>10.3f}{summary['max_ms']:>10.3f}")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@contextlib.contextmanager
+def spawned_server(size, backend="shelve"):
+    """
+    builds a library of size made up books in a temporary folder and serves it with python -m library serve.
+    yields the port
+    """
+    from filetest import Library
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "books")
+        print(f"building {size} books...", file=sys.stderr)
+        with contextlib.redirect_stdout(io.StringIO()):
+            library = Library(file_name, backend=backend)
+            library.import_books(make_rows(size))
+            library.close()
+
+        port = free_port()
+        process = subprocess.Popen([sys.executable, "-m", "library", "serve", "--file", file_name, "--port", str(port),
+                                    "--backend", backend, "--quiet"], cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            # wait for it to start listening
+            for attempt in range(300):
+                with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=1):
+                    break
+                if process.poll() is not None:
+                    raise RuntimeError("the server didn't start")
+                time.sleep(0.1)
+            yield port
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load test for python -m library serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--spawn", type=int, metavar="BOOKS",
+                        help="start a server on a new library with this many books instead of using --port")
+    parser.add_argument("--backend", choices=("shelve", "sqlite"), default="shelve", help="backend for --spawn")
+    parser.add_argument("--connections", type=int, default=16, help="keep-alive connections sending requests")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    arguments = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        port = arguments.port
+        if arguments.spawn is not None:
+            port = stack.enter_context(spawned_server(arguments.spawn, arguments.backend))
+        report = asyncio.run(run(arguments.host, port, arguments.connections, arguments.duration, arguments.seed))
+    print_report(report)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"report written to {arguments.output}")
@@ -1,18 +1,28 @@
+import time
+
+# taken before anything else is imported, for --measure-startup
+STARTED = time.perf_counter()
+
+import argparse
+import heapq
 from tkinter import messagebox
 from tkinter import *
 from filetest import Library
+from sharing import LibraryLockedError
+from worker import LibraryWorker
+import tracing
+from tracing import traced
 
 from ViewInventory import ViewInventoryPage
 
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,NavigationToolbar2Tk)
+# matplotlib is imported by ViewStatisticsPage the first time it's opened, since importing it is slow
 
 # Class to handle frame switching mechanism
 
 # App will be a subclass of Tk because it will behave like a window with all the features,
 # but also have the frame-switching functionality
 class App(Tk):
-    def __init__(self):
+    def __init__(self, measure_startup=False, metrics_file=None, slow_ms=100):
 
         # call the super constructor since we are overriding the init constructor of the Tk window with the frame-switching functionality
         super().__init__()
@@ -20,58 +30,160 @@ class App(Tk):
         # set the title and size of the window
         self.title("Library Inventory Manager")
         self.geometry("640x480")
+        self.measure_startup = measure_startup
+        self.metrics_file = metrics_file
+        self.slow_ms = slow_ms
+
+        # the library is opened in open_library() once the dashboard is on screen, so a big catalog doesn't keep
+        # the window from showing up
+        self.library = None
+        self.worker = None
+        # what the status bar shows when nothing is being saved
+        self.idle_status = ""
+
+        # the status bar at the bottom shows when the library is loading or something is still being saved
+        self.status = Label(self, text="", anchor="w", font=("Courier", 10))
+        self.status.pack(side="bottom", fill="x")
+        self.current_frame = None
+
+        # this is the main frame 'container' that holds all the frames
+        self.container = Frame(self)
+        self.container.pack(side="top", fill="both", expand=True)
+
+        # since the children frames use grid, configure the row and column so that those frames can expand correctly
+        self.container.grid_rowconfigure(0, weight=1)
+        self.container.grid_columnconfigure(0, weight=1)
+
+        # create an empty dict to store all frames, each frame is only built the first time it's shown (see get_frame)
+        self.frames = {}
+
+        # before, we used the class object like Dashboard, AddBookPage as the key, ex. self.frames[F] = frame
+        # but this required importing Dashboard and AddBookPage in ViewInventory.py
+        # which created a circular import since we also import ViewInventoryPage in this file
+        # so, to avoid the circular import, we use F.__name__ to call the actual instances of the frames, and it stores the class name as a string
+        # ex. If F = Dashboard, F.name = "Dashboard"
+        # so for the callbacks, we can just refer to the frames using strings, ex. "Dashboard", and require no importing
+        self.pages = {F.__name__: F for F in (Dashboard, AddBookPage, ViewInventoryPage, ViewStatisticsPage)}
+
+        # show the Dashboard page initially
+        self.show_frame("Dashboard")
+
+        # once Tk is idle (the dashboard has been drawn), load the library
+        self.after_idle(self.after, 10, self.open_library)
+
+        # close the library properly when the window is closed, so the ID counter gets saved next to the shelf
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def open_library(self):
+        if self.library is not None:
+            return
+        if self.measure_startup:
+            print(f"dashboard shown after {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+
+        self.status.config(text="Loading library...")
+        self.update_idletasks()
 
         # create an instance of the library persistant book database
         # this is how we can attach the backend to the frontend
-        self.library = Library("books")
+        # several windows can have the library open at once, but only the first one can change it. The others open it
+        # read-only and check every SYNC_DELAY ms for changes the first one made
+        try:
+            self.library = Library("books", access="writer")
+        except LibraryLockedError:
+            self.library = Library("books", access="reader")
+            self.idle_status = "Read-only: the library is open in another window"
+        if self.metrics_file:
+            self.library.enable_metrics(slow_ms=self.slow_ms, dump_file=self.metrics_file)
+
+        # every change to the library runs on a background thread through the worker, so saving never freezes
+        # the window
+        self.worker = LibraryWorker(self.library, self, on_busy=self.show_busy)
+        self.show_busy(0)
 
         # after initializing the library, create the preset books once by calling create_sample()
         # but only run this if the shelve database is currently empty
 
-        if self.library.stats_book_count() == 0:
-            self.library.create_sample()
+        if self.library.access == "reader":
+            self.after(self.SYNC_DELAY, self.sync_library)
+        elif self.library.stats_book_count() == 0:
+            self.worker.write("create_sample", callback=self.library_changed)
 
+        if self.measure_startup:
+            print(f"library loaded after {(time.perf_counter() - STARTED) * 1000:.0f} ms "
+                  f"({self.library.stats_book_count()} books)")
+            self.after(0, self.on_close)
 
-        # this is the main frame 'container' that holds all the frames
-        container = Frame(self)
-        container.pack(side="top", fill="both", expand=True)
+    # how often a read-only window checks for changes made in the other window
+    SYNC_DELAY = 1000
 
-        # since the children frames use grid, configure the row and column so that those frames can expand correctly
-        container.grid_rowconfigure(0, weight=1)
-        container.grid_columnconfigure(0, weight=1)
-
-        # create an empty dict to store all frames
-        self.frames = {}
-
-        for F in (Dashboard, AddBookPage, ViewInventoryPage, ViewStatisticsPage):
-            frame = F(container, self) # ex. frame = Dashboard(container, self), where container is the parent and self is App
+    def sync_library(self):
+        # sync_changes() updates the library, so it goes through the worker like any other change. Its first half
+        # only reads the disk, so the pages can keep reading while that runs
+        if self.worker.closed:
+            return
 
-            # before, we used the class object like Dashboard, AddBookPage as the key, ex. self.frames[F] = frame
-            # but this required importing Dashboard and AddBookPage in ViewInventory.py
-            # which created a circular import since we also import ViewInventoryPage in this file
-            # so, to avoid the circular import, we use F.__name__ to call the actual instances of the frames, and it stores the class name as a string
-            # ex. If F = Dashboard, F.name = "Dashboard"
-            # so for the callbacks, we can just refer to the frames using strings, ex. "Dashboard", and require no importing
-            self.frames[F.__name__] = frame
+        def synced(changed):
+            if changed != set():
+                self.library_changed()
+            self.after(self.SYNC_DELAY, self.sync_library)
+
+        def failed(error):
+            print(f"sync failed: {error}")
+            self.after(self.SYNC_DELAY, self.sync_library)
+        self.worker.write("apply_changes", prepare="load_changes", callback=synced, on_error=failed)
+
+    def on_close(self):
+        # let any saves that are still running finish first
+        if self.worker is not None:
+            self.worker.shutdown()
+        if self.library is not None:
+            self.library.close()
+        tracing.save()
+        self.destroy()
+
+    def get_frame(self, name):
+        if name not in self.frames:
+            # the library has to be open before any page that uses it gets built
+            if name != "Dashboard":
+                self.open_library()
+
+            frame = self.pages[name](self.container, self) # ex. frame = Dashboard(container, self), where container is the parent and self is App
+            self.frames[name] = frame
 
             # the children frames use grid so we can stack them and raise them accordingly
             frame.grid(row=0, column=0, sticky="nsew")
+        return self.frames[name]
 
-        # show the Dashboard page initially
-        self.show_frame("Dashboard")
+    def show_busy(self, pending):
+        if pending:
+            self.status.config(text=f"Saving... ({pending} left)")
+        else:
+            self.status.config(text=self.idle_status)
+
+    def library_changed(self, result=None):
+        # called when a background change finishes, so the page on screen shows it
+        if self.current_frame:
+            self.refresh_frame(self.current_frame)
 
     # this is the function we will call using lambda under each button to switch the frame accordingly
+    @traced("App.show_frame")
     def show_frame(self, name):
-        frame = self.frames[name]
+        frame = self.get_frame(name)
         frame.tkraise()
+        self.current_frame = name
+        self.refresh_frame(name)
+
+    def refresh_frame(self, name):
+        frame = self.frames[name]
 
         # must refresh the inventory page every time a new book is added/deleted/edited
+        # refresh() only updates the rows of books that changed since the page was last shown
         if name == "ViewInventoryPage":
-            frame.load_data()
+            frame.refresh()
 
-        # refresh the total inventory count label automatically in the stats page
+        # refresh the total inventory count label and the genre chart automatically in the stats page
         if name == "ViewStatisticsPage":
-            frame.label2.config(text="Total Inventory:" + str(self.library.stats_book_count()))
+            frame.refresh()
 
 
 # Dashboard UI Layout
@@ -188,6 +300,7 @@ class AddBookPage(Frame):
             self.controller.show_frame("Dashboard")
 
     # Save Book
+    @traced("AddBookPage.save_book")
     def save_book(self):
         title = self.title_entry.get().strip()
         author = self.author_entry.get().strip()
@@ -202,14 +315,18 @@ class AddBookPage(Frame):
 
         genre_list = [genre] if genre else []
 
-        # Save to backend
-        self.controller.library.add_book(title, author, publish, cost, genre_list)
-
-        messagebox.showinfo("Success", "Book saved successfully!")
+        # Save to backend, in the background so the window doesn't freeze
+        self.controller.worker.write("add_book", title, author, publish, cost, genre_list, callback=self.book_saved)
 
         # Clear fields 
         self.clear_fields()
 
+    # called once the book is actually saved
+    @traced("AddBookPage.book_saved")
+    def book_saved(self, result):
+        self.controller.library_changed()
+        messagebox.showinfo("Success", "Book saved successfully!")
+
 # class ViewInventoryPage(Frame):
 #     def __init__(self, parent, controller):
 #         super().__init__(parent)
@@ -225,6 +342,10 @@ class AddBookPage(Frame):
 #         self.button1.grid(row=0, column=0, sticky="se", padx=10, pady=10)
 
 class ViewStatisticsPage(Frame):
+
+    # how many genres get their own bar, the rest are added up into one "other" bar
+    TOP_GENRES = 10
+
     def __init__(self, parent, controller):
         super().__init__(parent)
 
@@ -245,43 +366,109 @@ class ViewStatisticsPage(Frame):
         # create a display of the total book count in the inventory
 
         # first, retrieve the total book count from the backend, store in a variable
-        total_books = self.controller.library.stats_book_count()
+        total_books = self.controller.worker.read_now("stats_book_count")
 
         # then, create a label to show the integer of total books
         self.label2 = Label(self, text='Total Inventory:' + str(total_books), font=("Courier", 14), bg="white")
         self.label2.grid(row=1, column=0, sticky="w", padx=20)
 
         # create a chart for the most popular book genre, which updates based on the data
+        # the figure, axes and bars are made once, after that update_chart() only changes the bar heights and labels
 
-        # retrieve the genre statistics dict from backend
-        genre_stats = controller.library.stats_tags()
-
-        # store keys and values in lists to be accessed by the x and y axes
-        genres = list(genre_stats.keys())
-        counts = list(genre_stats.values())
+        # matplotlib takes a while to import, so it's only loaded the first time this page is opened
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
         # create the figure
         fig = Figure(figsize=(5,5))
-        chart = fig.add_subplot(111)
+        self.chart = fig.add_subplot(111)
 
         # fig.tight_layout() # ensures nothing gets cut out
 
         # title and labels
-        chart.set_title('Book Genres by Popularity')
-        chart.bar(genres, counts)
-        chart.set_xlabel('Genres')
-        chart.set_ylabel('Count')
-        chart.tick_params(axis='x', labelsize=5)
-        chart.set_xticklabels(genres, rotation=45)
-
-        # embed the chart to tkinter
-        canvas = FigureCanvasTkAgg(fig, master=self)
-        canvas.draw()
-        canvas.get_tk_widget().grid(row=3, column=0, sticky='w', pady=10, padx=10)
-
-
+        self.chart.set_title('Book Genres by Popularity')
+        self.chart.set_xlabel('Genres')
+        self.chart.set_ylabel('Count')
+        self.chart.tick_params(axis='x', labelsize=5)
 
+        # the bars currently drawn, the (genres, counts) they show and the library version they were made from
+        self.bars = None
+        self.chart_data = None
+        self.chart_version = None
 
+        # embed the chart to tkinter
+        self.canvas = FigureCanvasTkAgg(fig, master=self)
+        if tracing.enabled():
+            # draw_idle() ends up calling this too, so every real redraw of the chart shows up in the trace
+            self.canvas.draw = traced("chart canvas.draw", "chart")(self.canvas.draw)
+        self.update_chart()
+        self.canvas.draw()
+        self.canvas.get_tk_widget().grid(row=3, column=0, sticky='w', pady=10, padx=10)
+
+    def refresh(self):
+        self.label2.config(text="Total Inventory:" + str(self.controller.worker.read_now("stats_book_count")))
+        self.update_chart()
+
+    def chart_counts(self):
+        # retrieve the genre statistics dict from backend
+        genre_stats = self.controller.worker.read_now("stats_tags")
+
+        # keep the TOP_GENRES biggest genres and add the rest up as "other", so thousands of tags stay readable
+        top = heapq.nlargest(self.TOP_GENRES, genre_stats.items(), key=lambda item: item[1])
+        other = sum(genre_stats.values()) - sum(count for genre, count in top)
+
+        # store keys and values in tuples to be accessed by the x and y axes
+        genres = tuple(genre for genre, count in top)
+        counts = tuple(count for genre, count in top)
+        if other:
+            genres += ("other",)
+            counts += (other,)
+        return genres, counts
+
+    @traced("ViewStatisticsPage.update_chart")
+    def update_chart(self):
+        # nothing was added, edited or deleted since the last update
+        version = self.controller.library.version
+        if version == self.chart_version:
+            return
+        self.chart_version = version
 
-app = App()
-app.mainloop()
+        data = self.chart_counts()
+        if data == self.chart_data:
+            return
+        self.chart_data = data
+        genres, counts = data
+
+        if self.bars is not None and len(self.bars) == len(counts):
+            # same number of bars, so just change their heights
+            for bar, count in zip(self.bars, counts):
+                bar.set_height(count)
+        else:
+            if self.bars is not None:
+                self.bars.remove()
+            self.bars = self.chart.bar(range(len(counts)), counts)
+
+        self.chart.set_xticks(range(len(genres)))
+        self.chart.set_xticklabels(genres, rotation=45)
+        self.chart.set_ylim(0, max(counts, default=0) * 1.1 or 1)
+
+        # only redraws once Tk is idle, and only because something actually changed
+        self.canvas.draw_idle()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Library Inventory Manager")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="print how long the dashboard and the library take to load, then quit")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="time every library call and save the numbers to FILE (as JSON) every minute and on exit")
+    parser.add_argument("--slow-ms", type=float, default=100,
+                        help="with --metrics, print any library call slower than this many milliseconds")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record how long each click takes and save it to FILE as Chrome trace events")
+    arguments = parser.parse_args()
+
+    if arguments.trace:
+        tracing.start(arguments.trace)
+    app = App(measure_startup=arguments.measure_startup, metrics_file=arguments.metrics, slow_ms=arguments.slow_ms)
+    app.mainloop()
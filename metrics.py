@@ -0,0 +1,225 @@
+import functools
+import json
+import os
+import pickle
+import threading
+import time
+
+from storage import ShelveBackend
+
+
+# the Library functions that get timed when metrics are turned on
+METHODS = ("add_book", "edit_book", "delete_book", "delete_books", "delete_all_books", "import_books",
+           "apply_filter", "search", "book_ids", "get_books", "changes_since", "flush", "close", "save_meta",
+           "stats_tags", "stats_books", "stats_genre_costs", "stats_inventory", "stats_book_count", "export",
+           "create_sample", "sync_changes", "load_changes", "apply_changes")
+
+# upper edges (in milliseconds) of the latency histogram buckets, anything slower goes in the last one
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class MethodStats:
+    """
+    the numbers kept for one Library function
+
+    calls, errors: how many times it was called, and how many of those raised an exception
+    total_ms, max_ms: time spent in it
+    histogram: how many calls landed in each BUCKETS_MS bucket (the last entry is for calls slower than all of them)
+    records_read, records_written: shelf records loaded or saved (or deleted) while the call was running
+    bytes_pickled: how many bytes of pickled data were written while the call was running
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        self.records_read = 0
+        self.records_written = 0
+        self.bytes_pickled = 0
+
+    def add_call(self, elapsed_ms, failed):
+        self.calls += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        bucket = 0
+        while bucket < len(BUCKETS_MS) and elapsed_ms > BUCKETS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def snapshot(self):
+        labels = [f"<={edge}ms" for edge in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "histogram": dict(zip(labels, self.histogram)),
+            "records_read": self.records_read,
+            "records_written": self.records_written,
+            "bytes_pickled": self.bytes_pickled
+        }
+
+
+class LibraryMetrics:
+    """
+    times the public functions of a Library and counts the records each one reads and writes. Made by
+    Library.enable_metrics(), it doesn't cost anything when it isn't turned on
+
+    the functions are wrapped on the library object itself, so calls made from inside the library (like add_book()
+    calling flush()) are counted too. Times are inclusive: add_book's time includes the flush it did, and so do its
+    records_written. Records and bytes are counted by wrapping the storage backend the same way
+
+    slow_ms: any call slower than this gets printed, None turns that off
+    dump_file: if given, snapshot() is written there as JSON every dump_every seconds and when the library closes
+    """
+    def __init__(self, library, slow_ms=100, dump_file=None, dump_every=60):
+        self.library = library
+        self.slow_ms = slow_ms
+        self.dump_file = dump_file
+        self.dump_every = dump_every
+        self.methods = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # the Library functions running right now on each thread, innermost last
+        self.local = threading.local()
+        self.timer = None
+
+        self.wrap_store(library.store)
+        for name in METHODS:
+            setattr(library, name, self.wrap(name, getattr(library, name)))
+
+        # the last dump happens after close() has been counted
+        close = library.close
+
+        @functools.wraps(close)
+        def closing():
+            try:
+                return close()
+            finally:
+                self.stop()
+        library.close = closing
+        if dump_file:
+            self.schedule_dump()
+
+    def active(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def stats_for(self, name):
+        if name not in self.methods:
+            self.methods[name] = MethodStats()
+        return self.methods[name]
+
+    def wrap(self, name, method):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            stack = self.active()
+            stack.append(name)
+            failed = False
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                stack.pop()
+                with self.lock:
+                    self.stats_for(name).add_call(elapsed_ms, failed)
+                if self.slow_ms is not None and elapsed_ms > self.slow_ms:
+                    print(f"slow call: {name} took {elapsed_ms:.1f} ms")
+        return timed
+
+    def count(self, records_read=0, records_written=0, bytes_pickled=0):
+        # adds to every Library function that is running on this thread, the outer calls include the inner ones
+        with self.lock:
+            for name in set(self.active()):
+                stats = self.stats_for(name)
+                stats.records_read += records_read
+                stats.records_written += records_written
+                stats.bytes_pickled += bytes_pickled
+
+    def wrap_store(self, store):
+        load_all, get, write = store.load_all, store.get, store.write
+        # shelves pickle every book they save, the SQLite backend stores plain columns instead. A shared library's
+        # store is wrapped in a sharing.SharedBackend, the real one is inside it
+        pickles = isinstance(getattr(store, "backend", store), ShelveBackend)
+
+        def counted_load_all():
+            books = load_all()
+            self.count(records_read=len(books))
+            return books
+
+        def counted_get(key):
+            book = get(key)
+            self.count(records_read=book is not None)
+            return book
+
+        def counted_write(changed, deleted, counters=None):
+            size = sum(len(pickle.dumps(book)) for book in changed.values()) if pickles else 0
+            write(changed, deleted, counters)
+            self.count(records_written=len(changed) + len(deleted), bytes_pickled=size)
+
+        store.load_all, store.get, store.write = counted_load_all, counted_get, counted_write
+
+        # save_meta writes the snapshot (with the indexes pickled inside it) and returns how big it came out
+        save_meta = self.library.save_meta
+
+        @functools.wraps(save_meta)
+        def counted_save_meta():
+            written = save_meta()
+            self.count(bytes_pickled=written or 0)
+            return written
+        self.library.save_meta = counted_save_meta
+
+    def snapshot(self):
+        """
+        returns the numbers so far as a dictionary: {"uptime_seconds": ..., "methods": {name: {calls, mean_ms, ...}}}
+        """
+        with self.lock:
+            methods = {name: stats.snapshot() for name, stats in sorted(self.methods.items())}
+        return {"uptime_seconds": round(time.time() - self.started, 3), "methods": methods}
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.started = time.time()
+
+    def dump(self, file_name=None):
+        """
+        writes snapshot() to file_name (dump_file by default) as JSON. The file is replaced in one step, so a reader
+        never sees half of it
+        """
+        file_name = file_name or self.dump_file
+        temporary = file_name + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(temporary, file_name)
+
+    def schedule_dump(self):
+        self.timer = threading.Timer(self.dump_every, self.periodic_dump)
+        # a daemon thread, so a forgotten timer never keeps the program open
+        self.timer.daemon = True
+        self.timer.start()
+
+    def periodic_dump(self):
+        try:
+            self.dump()
+        except OSError as error:
+            print(f"metrics dump failed: {error}")
+        self.schedule_dump()
+
+    def stop(self):
+        """
+        stops the periodic dump and writes one last one
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.dump_file:
+            self.dump()
@@ -0,0 +1,483 @@
+import asyncio
+import itertools
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from filetest import Library, parse_book_row, parse_publish_date, parse_cost, parse_genre_tags
+from indexes import TextIndex
+from worker import ReadWriteLock
+
+
+# a small HTTP/1.1 server that puts a Library on the network, so kiosks and scripts can use the catalog without the
+# Tk window. Start it with python -m library serve. Every answer is JSON:
+#
+#   GET    /search?q=text&fields=name,author&prefix=1&limit=100    books whose fields contain text (all by default)
+#   GET    /filter?name=&author=&genre=a,b&year_min=&year_max=&cost_min=&cost_max=&publish=&cost=&limit=100
+#   GET    /stats, /stats/tags, /stats/books, /stats/genre_costs     the totals (cached until something changes)
+#   GET    /books/<ID>                                              one book
+#   POST   /books          {"name", "author", "publish_date", "cost", "genre_tags"}      adds a book
+#   PATCH  /books/<ID>     any of the same fields                                       edits a book
+#   DELETE /books/<ID>                                              deletes a book
+#   POST   /batch          {"requests": [{"method", "path", "body"}, ...]}   several requests in one round trip
+#
+# reads run on a small pool of reader threads, so a read waiting for the writer never holds up the event loop. Every
+# change goes through one writer thread: changes that arrive while it's busy are made together and written to the
+# shelf in a single flush before any of them is answered
+
+# changes made in one go by the writer, and requests allowed in one /batch
+MAX_BATCH = 256
+# bigger request bodies are turned away
+MAX_BODY = 1 << 20
+# how long an idle keep-alive connection stays open, in seconds
+KEEP_ALIVE_TIMEOUT = 15
+# how many books /search and /filter return when no limit is given
+DEFAULT_LIMIT = 100
+# threads answering reads
+READ_THREADS = 4
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+# the book fields a request can set
+BOOK_FIELDS = ("name", "author", "publish_date", "cost", "genre_tags")
+
+
+class HTTPError(Exception):
+    """
+    raised by a handler to answer with an error status, the message is sent back as {"error": message}
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def book_to_json(book):
+    return book.get_stats()
+
+
+def parse_book_fields(body, partial=False):
+    """
+    checks a JSON body with book fields. returns (name, author, publish_date, cost, genre_tags) for a new book, or
+    with partial=True (for edits, where every field is optional) a dictionary of just the fields that were sent
+    """
+    if not isinstance(body, dict):
+        raise HTTPError(400, "the body has to be a JSON object")
+    unknown = set(body) - set(BOOK_FIELDS)
+    if unknown:
+        raise HTTPError(400, f"unknown fields: {', '.join(sorted(unknown))}")
+    tags = body.get("genre_tags", [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise HTTPError(400, "genre_tags has to be a list of strings")
+    try:
+        if not partial:
+            return parse_book_row(body)
+        fields = {}
+        for field, value in body.items():
+            if field in ("name", "author"):
+                fields[field] = str(value or "").strip()
+                if not fields[field]:
+                    raise ValueError(f"{field} can't be empty")
+            elif field == "publish_date":
+                fields[field] = parse_publish_date(value)
+            elif field == "cost":
+                fields[field] = parse_cost(value)
+            else:
+                fields[field] = parse_genre_tags(value)
+        return fields
+    except ValueError as error:
+        raise HTTPError(400, str(error))
+
+
+def query_value(query, name, convert=str, default=None):
+    # one value from a parsed query string, converted (a bad value is the client's fault, so it's a 400)
+    if name not in query:
+        return default
+    try:
+        return convert(query[name][-1])
+    except ValueError:
+        raise HTTPError(400, f"bad value for {name}: {query[name][-1]!r}")
+
+
+def query_flag(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+def query_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class LibraryServer:
+    """
+    answers HTTP requests for one Library
+
+    lock: keeps reads out while the writer changes books in memory (but not while it writes them to disk), the same
+            way worker.LibraryWorker does it for the Tk window
+    readers: the threads reads run on (see read())
+    writes: the changes waiting for the writer thread, as (function, args, future)
+    stats_cache: the encoded answer of every /stats request, with the library version it was made at
+    requests, batches, batched_writes: counters shown by GET /server
+    """
+    def __init__(self, library):
+        self.library = library
+        self.lock = ReadWriteLock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library-writer")
+        self.readers = ThreadPoolExecutor(max_workers=READ_THREADS, thread_name_prefix="library-reader")
+        self.writes = None
+        self.stats_cache = {}
+        self.started = time.time()
+        self.requests = 0
+        self.batches = 0
+        self.batched_writes = 0
+        # the writer thread flushes once per batch instead
+        self.library.autoflush = False
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """
+        listens on host:port until the task is cancelled or the process gets SIGINT/SIGTERM
+        """
+        self.writes = asyncio.Queue()
+        writer_task = asyncio.create_task(self.write_loop())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                # not available on Windows, Ctrl+C still stops asyncio.run() there
+                pass
+        address = server.sockets[0].getsockname()
+        print(f"serving {self.library.file_name} on http://{address[0]}:{address[1]}", file=sys.stderr)
+        try:
+            async with server:
+                await stopped.wait()
+        finally:
+            server.close()
+            # let the changes that were already accepted finish
+            await self.writes.join()
+            writer_task.cancel()
+            self.writer.shutdown(wait=True)
+            self.readers.shutdown(wait=True)
+
+    # connections
+
+    async def handle_connection(self, reader, writer):
+        """
+        reads requests off one connection and answers them in order. HTTP/1.1 connections stay open (keep-alive)
+        until the client closes them, asks for Connection: close, or is idle for KEEP_ALIVE_TIMEOUT seconds
+        """
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.send(writer, 400, {"error": "bad request line"}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    await self.send(writer, 400, {"error": "bad Content-Length"}, False)
+                    break
+                if length > MAX_BODY:
+                    await self.send(writer, 413, {"error": f"bodies are limited to {MAX_BODY} bytes"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, payload = await self.dispatch(method, target, body)
+                await self.send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client went away in the middle of a request
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, status, payload, keep_alive):
+        # payload is either something to encode as JSON, or bytes that already are (the stats cache)
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def dispatch(self, method, target, body):
+        """
+        runs one request, returns (status, payload)
+        """
+        self.requests += 1
+        url = urlsplit(target)
+        path = url.path.rstrip("/") or "/"
+        query = parse_qs(url.query)
+        try:
+            if body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    raise HTTPError(400, "the body isn't valid JSON")
+            else:
+                body = None
+
+            if path == "/search" and method == "GET":
+                return 200, await self.read(self.search, query)
+            if path == "/filter" and method == "GET":
+                return 200, await self.read(self.filter, query)
+            if path.startswith("/stats") and method == "GET":
+                return 200, await self.stats(path)
+            if path == "/server" and method == "GET":
+                return 200, self.server_stats()
+            if path == "/batch" and method == "POST":
+                return 200, await self.batch(body)
+            if path == "/books" and method == "POST":
+                return 201, await self.write(self.add_book, parse_book_fields(body))
+            if path.startswith("/books/"):
+                key = path[len("/books/"):]
+                if method == "GET":
+                    return 200, await self.read(self.get_book, key)
+                if method == "PATCH":
+                    return 200, await self.write(self.edit_book, key, parse_book_fields(body, partial=True))
+                if method == "DELETE":
+                    return 200, await self.write(self.delete_book, key)
+            raise HTTPError(404 if method in ("GET", "POST", "PATCH", "DELETE") else 405,
+                            f"no such endpoint: {method} {path}")
+        except HTTPError as error:
+            return error.status, {"error": error.message}
+        except PermissionError as error:
+            return 409, {"error": str(error)}
+        except Exception as error:
+            print(f"{method} {target} failed: {error!r}", file=sys.stderr)
+            return 500, {"error": str(error)}
+
+    # reads
+
+    async def read(self, function, *args):
+        """
+        runs function(*args) on a reader thread under the read lock and returns what it returned. Waiting for the
+        writer thread (or for the disk, in a lazy library) happens there instead of on the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self.locked_read, function, args)
+
+    def locked_read(self, function, args):
+        # runs on a reader thread
+        with self.lock.reading():
+            return function(*args)
+
+    # these run on a reader thread, inside locked_read()
+
+    def search(self, query):
+        text = query_value(query, "q", default="")
+        fields = query_value(query, "fields", query_list, TextIndex.FIELDS)
+        prefix = query_value(query, "prefix", query_flag, False)
+        limit = query_value(query, "limit", int, DEFAULT_LIMIT)
+        try:
+            found = self.library.search(text, fields=fields, prefix=prefix)
+        except (KeyError, ValueError) as error:
+            raise HTTPError(400, f"bad search: {error}")
+        return {"count": len(found), "books": [book_to_json(found[key]) for key in list(found)[:limit]]}
+
+    def filter(self, query):
+        filters = {
+            "name": query_value(query, "name", default=False),
+            "author": query_value(query, "author", default=False),
+            "publish": query_value(query, "publish", default=False),
+            "cost": query_value(query, "cost", default=False),
+            "genre_tags": query_value(query, "genre", query_list, False),
+            "year_min": query_value(query, "year_min", float),
+            "year_max": query_value(query, "year_max", float),
+            "cost_min": query_value(query, "cost_min", float),
+            "cost_max": query_value(query, "cost_max", float)
+        }
+        limit = query_value(query, "limit", int, DEFAULT_LIMIT)
+        # match_filter() leaves filtered_inventory alone, so filters can run side by side and only the books that
+        # are sent get looked up
+        try:
+            matched = self.library.match_filter(**filters)
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        inventory = self.library.inventory
+        if matched is None:
+            return {"count": len(inventory),
+                    "books": [book_to_json(inventory[key]) for key in itertools.islice(inventory, limit)]}
+        return {"count": len(matched), "books": [book_to_json(inventory[key]) for key in matched[:limit]]}
+
+    # the /stats endpoints and the Library function behind each one
+    STATS = {
+        "/stats/tags": "stats_tags",
+        "/stats/books": "stats_books",
+        "/stats/genre_costs": "stats_genre_costs"
+    }
+
+    async def stats(self, path):
+        """
+        the totals are cached as encoded JSON with the version they were made at, so repeated requests cost a
+        dictionary lookup on the event loop until a book changes
+        """
+        if path != "/stats" and path not in self.STATS:
+            raise HTTPError(404, f"no such endpoint: GET {path}")
+        cached = self.stats_cache.get(path)
+        if cached is not None and cached[0] == self.library.version:
+            return cached[1]
+        version, encoded = await self.read(self.make_stats, path)
+        self.stats_cache[path] = (version, encoded)
+        return encoded
+
+    def make_stats(self, path):
+        # returns (version, encoded totals) for one of the /stats endpoints
+        version = self.library.version
+        if path == "/stats":
+            payload = {
+                "book_count": self.library.stats_book_count(),
+                "genres": self.library.stats_tags(),
+                "genre_costs": self.library.stats_genre_costs(),
+                "version": version
+            }
+        else:
+            payload = getattr(self.library, self.STATS[path])()
+        return version, json.dumps(payload, default=str).encode("utf-8")
+
+    def get_book(self, key):
+        book = self.library.inventory.get(key)
+        if book is None:
+            raise HTTPError(404, f"no book with ID {key}")
+        return book_to_json(book)
+
+    def server_stats(self):
+        return {
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "requests": self.requests,
+            "batches": self.batches,
+            "batched_writes": self.batched_writes,
+            "books": self.library.stats_book_count(),
+            "version": self.library.version
+        }
+
+    async def batch(self, body):
+        """
+        answers several requests at once. They run together, so their changes end up in the same flush. The changes
+        are made in the order they're listed, but a read in the same batch may see the library before them
+        """
+        if not isinstance(body, dict) or not isinstance(body.get("requests"), list):
+            raise HTTPError(400, 'the body has to be {"requests": [...]}')
+        if len(body["requests"]) > MAX_BATCH:
+            raise HTTPError(413, f"a batch can have at most {MAX_BATCH} requests")
+        calls = []
+        for request in body["requests"]:
+            if not isinstance(request, dict) or "path" not in request:
+                raise HTTPError(400, "every request needs a path")
+            inner = request.get("body")
+            calls.append(self.dispatch(request.get("method", "GET").upper(), str(request["path"]),
+                                       json.dumps(inner).encode("utf-8") if inner is not None else b""))
+        responses = []
+        for status, payload in await asyncio.gather(*calls):
+            responses.append({"status": status, "body": json.loads(payload) if isinstance(payload, bytes) else payload})
+        return {"responses": responses}
+
+    # writes
+
+    async def write(self, function, *args):
+        """
+        hands a change to the writer thread and waits until it's on disk. returns what function returned
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.writes.put((function, args, future))
+        return await future
+
+    async def write_loop(self):
+        # takes every change that is waiting (up to MAX_BATCH) and makes them together, with one flush at the end
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < MAX_BATCH and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            try:
+                outcomes = await loop.run_in_executor(self.writer, self.run_writes, batch)
+            except Exception as error:
+                # the flush failed, so none of the changes can be called saved
+                outcomes = [(False, error)] * len(batch)
+            for (function, args, future), (succeeded, result) in zip(batch, outcomes):
+                if not future.done():
+                    if succeeded:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+                self.writes.task_done()
+            self.batches += 1
+            self.batched_writes += len(batch)
+
+    def run_writes(self, batch):
+        # runs on the writer thread
+        outcomes = []
+        with self.lock.writing():
+            for function, args, future in batch:
+                try:
+                    outcomes.append((True, function(*args)))
+                except Exception as error:
+                    outcomes.append((False, error))
+        self.library.flush()
+        return outcomes
+
+    # these run on the writer thread, inside run_writes()
+
+    def add_book(self, fields):
+        name, author, publish, cost, genre_tags = fields
+        book_id = self.library.add_book(name, author, publish, cost, genre_tags)
+        return book_to_json(self.library.inventory[str(book_id)])
+
+    def edit_book(self, key, fields):
+        if key not in self.library.inventory:
+            raise HTTPError(404, f"no book with ID {key}")
+        # only the fields that were sent change (parse_book_fields() already checked them), the rest are left at
+        # False so edit_book() keeps them as they are
+        self.library.edit_book(key, name=fields.get("name", False), author=fields.get("author", False),
+                               publish_date=fields.get("publish_date", False), cost=fields.get("cost", False),
+                               genre=fields.get("genre_tags", False))
+        return book_to_json(self.library.inventory[key])
+
+    def delete_book(self, key):
+        if key not in self.library.inventory:
+            raise HTTPError(404, f"no book with ID {key}")
+        self.library.delete_book(key)
+        return {"deleted": key}
+
+
+def serve(file_name="books", host="127.0.0.1", port=8080, backend="shelve", quiet=False):
+    """
+    opens the library as its writer (see sharing.py, so Tk windows can still open it read-only) and serves it until
+    the process is stopped. quiet hides the line Library prints for every change
+    """
+    library = Library(file_name, backend=backend, access="writer")
+    server = LibraryServer(library)
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        library.close()
+        print("library closed", file=sys.stderr)
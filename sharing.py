@@ -0,0 +1,296 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+    SHARED, EXCLUSIVE, UNLOCK = fcntl.LOCK_SH, fcntl.LOCK_EX, fcntl.LOCK_UN
+except ImportError:
+    # not available on Windows, the locks there only work between threads of one program
+    fcntl = None
+    SHARED = EXCLUSIVE = UNLOCK = None
+
+
+# lets several programs open the same library at once (Library(..., access="writer" or "reader")). Only one of them
+# can be the writer, the rest are readers. Next to the shelf there are three extra files:
+#   <file>.writer: locked by the writer for as long as it has the library open, so a second writer can't open it
+#   <file>.lock: locked while the store is used. Readers share it, the writer locks it on its own while it writes
+#   <file>.changes: the change journal. Every flush by the writer adds a line "<generation> <ID>" for each book it
+#       wrote or deleted ("*" instead of an ID means everything changed), so readers only reload those books
+
+
+class LibraryLockedError(RuntimeError):
+    """
+    raised when a library is opened with access="writer" while another program is already writing to it
+    """
+
+
+class FileLock:
+    """
+    a reader/writer lock on a file, shared between programs with fcntl.flock. Inside one program it's also a
+    reentrant thread lock, so a thread can take it again while holding it (and upgrade from shared to exclusive)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.exclusive_held = False
+
+    def flock(self, operation):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), operation)
+
+    @contextmanager
+    def hold(self, exclusive):
+        with self.thread_lock:
+            upgraded = False
+            if self.depth == 0:
+                self.flock(EXCLUSIVE if exclusive else SHARED)
+                self.exclusive_held = exclusive
+            elif exclusive and not self.exclusive_held:
+                self.flock(EXCLUSIVE)
+                self.exclusive_held = upgraded = True
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.flock(UNLOCK)
+                    self.exclusive_held = False
+                elif upgraded:
+                    self.flock(SHARED)
+                    self.exclusive_held = False
+
+    def shared(self):
+        return self.hold(False)
+
+    def exclusive(self):
+        return self.hold(True)
+
+    def close(self):
+        self.file.close()
+
+
+class ChangeJournal:
+    """
+    the <file>.changes file. The writer appends to it on every flush, readers remember how far they've read and
+    only look at what was added since
+
+    generation: the last generation written (writer) or read (reader)
+    position: how many bytes of the file have been read
+    inode: which file was read, the writer replaces the file with a fresh one when it gets too big
+    """
+    # past this size the writer starts a new journal
+    MAX_SIZE = 1000000
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.position = 0
+        self.inode = None
+
+    def start(self):
+        """
+        skips to the end of the journal, call it right after loading the store (under the same lock)
+        """
+        self.generation, self.position, self.inode = 0, 0, None
+        self.read_new()
+
+    def read_new(self):
+        """
+        returns the IDs (as strings) changed since the last call, or None if everything has to be reloaded
+        """
+        try:
+            with open(self.path, "rb") as file:
+                inode = os.fstat(file.fileno()).st_ino
+                if inode != self.inode:
+                    # a new journal, read it from the start
+                    self.inode = inode
+                    self.position = 0
+                file.seek(self.position)
+                data = file.read()
+        except FileNotFoundError:
+            return set()
+        self.position += len(data)
+
+        changed = set()
+        newest = self.generation
+        for line in data.decode("utf-8").splitlines():
+            generation, key = line.split(" ", 1)
+            generation = int(generation)
+            newest = max(newest, generation)
+            if key == ".":
+                # the first line of a new journal. If it starts after a generation that was never read, some
+                # changes can't be known
+                if generation > self.generation + 1:
+                    changed = None
+            elif generation <= self.generation:
+                continue
+            elif key == "*":
+                changed = None
+            elif changed is not None:
+                changed.add(key)
+        self.generation = newest
+        return changed
+
+    def state(self):
+        # changes whenever the writer adds to the journal or starts a new one
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return info.st_ino, info.st_size
+
+    def append(self, keys, everything=False):
+        """
+        records one flush by the writer. Call it while holding the exclusive lock
+        """
+        self.generation += 1
+        lines = [f"{self.generation} *"] if everything else [f"{self.generation} {key}" for key in keys]
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size + len(data) > self.MAX_SIZE:
+            # start a new journal, readers that fell behind the old one reload everything
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as file:
+                file.write(f"{self.generation} .\n".encode("utf-8") + data)
+            os.replace(temporary, self.path)
+        else:
+            with open(self.path, "ab") as file:
+                file.write(data)
+
+
+class Sharing:
+    """
+    everything a Library needs to share its files with other programs
+
+    access: "writer" or "reader"
+    lock: the FileLock around the store
+    journal: the ChangeJournal
+    """
+    def __init__(self, file_name, access):
+        if access not in ("writer", "reader"):
+            raise ValueError(f"unknown access mode: {access}")
+        self.access = access
+        self.writer_file = None
+        if access == "writer":
+            self.writer_file = open(file_name + ".writer", "a+b")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.writer_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self.writer_file.close()
+                    raise LibraryLockedError(f"{file_name} is already open for writing by another program")
+        self.lock = FileLock(file_name + ".lock")
+        self.journal = ChangeJournal(file_name + ".changes")
+
+    def close(self):
+        self.lock.close()
+        if self.writer_file is not None:
+            # closing the file lets go of the writer lock
+            self.writer_file.close()
+            self.writer_file = None
+
+
+class SharedBackend:
+    """
+    wraps a storage backend so every use of it holds the shared file lock, and every write the exclusive one
+
+    for a reader it also keeps the store from going stale. Some dbm modules (gdbm, dumb) keep part of the file in
+    memory, so once the writer has saved something the store is reopened before it's read again
+
+    ahead: True from then until the reader's next sync_changes(). The store can have newer books than the ones the
+            library has indexed while it's True
+    thread_lock: keeps threads of this program from reading the backend while another one reopens it. It's always
+                 taken before the file lock, a thread that had them the other way round could deadlock with one
+                 reading the store
+    """
+    def __init__(self, backend, sharing):
+        self.backend = backend
+        self.sharing = sharing
+        self.ahead = False
+        self.thread_lock = threading.RLock()
+        # the library is loaded under the same lock, so the store matches the journal as it is now
+        self.journal_state = sharing.journal.state()
+
+    @contextmanager
+    def reading(self):
+        with self.thread_lock, self.sharing.lock.shared():
+            if self.sharing.access == "reader":
+                state = self.sharing.journal.state()
+                if state != self.journal_state:
+                    self.backend.reopen()
+                    self.journal_state = state
+                    self.ahead = True
+            yield
+
+    def load_all(self):
+        with self.reading():
+            return self.backend.load_all()
+
+    def keys(self):
+        with self.reading():
+            return self.backend.keys()
+
+    def get(self, key):
+        with self.reading():
+            return self.backend.get(key)
+
+    def __contains__(self, key):
+        with self.reading():
+            return key in self.backend
+
+    def __len__(self):
+        with self.reading():
+            return len(self.backend)
+
+    def write(self, changed, deleted, counters=None):
+        with self.thread_lock, self.sharing.lock.exclusive():
+            self.backend.write(changed, deleted, counters)
+            self.backend.sync()
+            keys = list(changed) + list(deleted)
+            if keys:
+                self.sharing.journal.append(keys)
+
+    def load_counters(self):
+        with self.reading():
+            return self.backend.load_counters()
+
+    def clear(self):
+        with self.thread_lock, self.sharing.lock.exclusive():
+            self.backend.clear()
+            self.backend.sync()
+            self.sharing.journal.append((), everything=True)
+
+    def reopen(self):
+        # reload_all() calls this before it reads everything, after that the library matches the store again
+        with self.thread_lock, self.sharing.lock.shared():
+            self.backend.reopen()
+            self.journal_state = self.sharing.journal.state()
+            self.ahead = False
+
+    def caught_up(self, state):
+        """
+        sync_changes() has put every change up to this journal state into the library. Unless the writer saved
+        something after that, the library matches the store again
+        """
+        with self.thread_lock, self.sharing.lock.shared():
+            if self.sharing.journal.state() != state:
+                return
+            if self.journal_state != state:
+                self.backend.reopen()
+                self.journal_state = state
+            self.ahead = False
+
+    def sync(self):
+        with self.thread_lock, self.sharing.lock.exclusive():
+            self.backend.sync()
+
+    def close(self):
+        # the locks stay until Library.close() has put the snapshot in place, then it closes the sharing
+        self.backend.close()
@@ -0,0 +1,309 @@
+import bisect
+import json
+import mmap
+import os
+import pickle
+import sys
+from array import array
+
+from indexes import to_number
+
+
+# a snapshot is a single binary file next to the shelf that holds every book and index, written by Library.close().
+# The next Library(...) opens it with mmap and reads it in place instead of unpickling the whole shelf and rebuilding
+# the indexes. It's laid out like this:
+#
+#   HEADER_SIZE bytes: MAGIC, then a JSON header (format version, book count, the stamp of the shelf files it was
+#       made from, and where each section starts), padded with spaces
+#   sections, each starting on an 8 byte boundary:
+#       ids, years, costs: one fixed-width number per book, in ID order
+#       year_kinds, cost_kinds: one byte per book telling what type its publish date and cost were (INT, TEXT, ...)
+#       offsets: where each string starts in the heap, SLOTS strings per book, plus one extra for the end
+#       heap: every string, UTF-8 encoded, one after the other
+#       year_numbers, year_ids, cost_numbers, cost_ids: the sorted indexes, already sorted
+#       meta: a pickle of everything else (ID counter, genre index, text index, stats)
+#
+# the numbers are written in this computer's byte order so they can be read in place, a snapshot from a computer
+# with the other byte order is treated as stale
+
+MAGIC = b"LIBSNAP\0"
+# 2: the text index also covers publish_date and cost
+FORMAT_VERSION = 2
+HEADER_SIZE = 4096
+
+# the strings kept for each book
+SLOTS = ("name", "author", "genre_tags", "publish_date", "cost")
+
+# what type a publish date or cost was, so it comes back exactly the same. Numbers are kept in the fixed-width column,
+# text in the heap, and anything else is pickled into the heap
+INT, FLOAT, TEXT, NONE, PICKLED = range(5)
+
+# genre tags are kept as one string, split by this character. A book whose genre_tags is a single string (which
+# older code could save) starts with TEXT_TAGS instead
+TAG_SEPARATOR = "\x1f"
+TEXT_TAGS = "\x1e"
+
+# files next to the shelf that the stamp looks at. Depending on the dbm module a shelf is one file or several, and a
+# SQLite database can have a -wal file
+STORE_SUFFIXES = ("", ".db", ".dat", ".dir", ".bak", ".pag", "-wal")
+
+
+def store_stamp(file_name):
+    """
+    returns the size and modification time of every file the store is kept in. If any of them changes after a
+    snapshot was made, the snapshot is out of date
+    """
+    stamp = []
+    for suffix in STORE_SUFFIXES:
+        try:
+            info = os.stat(file_name + suffix)
+        except OSError:
+            continue
+        stamp.append([suffix, info.st_size, info.st_mtime_ns])
+    return stamp
+
+
+def split_value(value):
+    # returns (kind, number for the column, bytes for the heap)
+    if isinstance(value, bool):
+        return PICKLED, to_number(value) or 0.0, pickle.dumps(value)
+    if isinstance(value, int) and abs(value) < 2 ** 53:
+        return INT, float(value), b""
+    if isinstance(value, float):
+        return FLOAT, value, b""
+    if isinstance(value, str):
+        number = to_number(value)
+        return TEXT, float("nan") if number is None else number, value.encode("utf-8")
+    if value is None:
+        return NONE, float("nan"), b""
+    number = to_number(value)
+    return PICKLED, float("nan") if number is None else number, pickle.dumps(value)
+
+
+def join_value(kind, number, data):
+    if kind == INT:
+        return int(number)
+    if kind == FLOAT:
+        return number
+    if kind == TEXT:
+        return data.decode("utf-8")
+    if kind == NONE:
+        return None
+    return pickle.loads(data)
+
+
+def write_snapshot(file_name, books, year_entries, cost_entries, meta):
+    """
+    writes a snapshot of books (any iterable of Book, in ID order) and the given indexes to file_name, with an empty
+    stamp. stamp_snapshot() fills the stamp in once the store is closed. returns how many bytes were written
+
+    year_entries, cost_entries: the SortedIndex entries, (number, ID) pairs in order
+    meta: a dictionary with everything else that should be saved, it's pickled as is
+    """
+    ids = array("q")
+    years = array("d")
+    costs = array("d")
+    year_kinds = array("B")
+    cost_kinds = array("B")
+    offsets = array("Q", [0])
+    heap = bytearray()
+
+    for book in books:
+        ids.append(int(book.ID))
+        tags = book.genre_tags
+        tags = TEXT_TAGS + tags if isinstance(tags, str) else TAG_SEPARATOR.join(tags)
+        year_kind, year, year_data = split_value(book.publish_date)
+        cost_kind, cost, cost_data = split_value(book.cost)
+        years.append(year)
+        costs.append(cost)
+        year_kinds.append(year_kind)
+        cost_kinds.append(cost_kind)
+        for data in (book.name.encode("utf-8"), book.author.encode("utf-8"), tags.encode("utf-8"),
+                     year_data, cost_data):
+            heap += data
+            offsets.append(len(heap))
+
+    sections = {
+        "ids": ids, "years": years, "costs": costs, "year_kinds": year_kinds, "cost_kinds": cost_kinds,
+        "offsets": offsets, "heap": bytes(heap),
+        "year_numbers": array("d", (number for number, book_id in year_entries)),
+        "year_ids": array("q", (book_id for number, book_id in year_entries)),
+        "cost_numbers": array("d", (number for number, book_id in cost_entries)),
+        "cost_ids": array("q", (book_id for number, book_id in cost_entries)),
+        "meta": pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    }
+    header = {
+        "version": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "book_count": len(ids),
+        "stamp": [],
+        "sections": {}
+    }
+    with open(file_name, "wb") as file:
+        file.write(b"\0" * HEADER_SIZE)
+        for name, data in sections.items():
+            position = file.tell()
+            padding = -position % 8
+            file.write(b"\0" * padding)
+            data = data.tobytes() if isinstance(data, array) else data
+            header["sections"][name] = [position + padding, len(data), data_format(sections[name])]
+            file.write(data)
+        size = file.tell()
+    write_header(file_name, header)
+    return size
+
+
+def data_format(data):
+    # the memoryview format a section is read back with
+    return data.typecode if isinstance(data, array) else "B"
+
+
+def write_header(file_name, header):
+    encoded = MAGIC + json.dumps(header).encode("utf-8")
+    if len(encoded) > HEADER_SIZE:
+        raise ValueError("snapshot header is too big")
+    with open(file_name, "r+b") as file:
+        file.write(encoded.ljust(HEADER_SIZE, b" "))
+
+
+def read_header(file):
+    data = file.read(HEADER_SIZE)
+    if not data.startswith(MAGIC):
+        raise ValueError("not a snapshot file")
+    return json.loads(data[len(MAGIC):].decode("utf-8"))
+
+
+def stamp_snapshot(file_name, stamp):
+    """
+    records which state of the store the snapshot matches, by rewriting its header in place
+    """
+    with open(file_name, "rb") as file:
+        header = read_header(file)
+    header["stamp"] = stamp
+    write_header(file_name, header)
+
+
+class PairColumns:
+    """
+    a read-only list of (number, ID) pairs made from two columns of a snapshot, so a SortedIndex can search the
+    saved entries without copying them first
+    """
+    def __init__(self, numbers, ids):
+        self.numbers = numbers
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return list(zip(self.numbers[position].tolist(), self.ids[position].tolist()))
+        return self.numbers[position], self.ids[position]
+
+    def __iter__(self):
+        return zip(self.numbers, self.ids)
+
+
+class Snapshot:
+    """
+    an open snapshot file, mapped into memory with mmap and read in place
+
+    book_count, stamp: from the header
+    columns: the sections as memoryviews over the file, nothing is copied until a book is asked for
+    """
+    def __init__(self, file_name):
+        with open(file_name, "rb") as file:
+            header = read_header(file)
+            if header.get("version") != FORMAT_VERSION or header.get("byteorder") != sys.byteorder:
+                raise ValueError("snapshot was written by a different version or computer")
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.book_count = header["book_count"]
+        self.stamp = header["stamp"]
+        view = memoryview(self.map)
+        self.views = [view]
+        self.columns = {}
+        for name, (start, length, data_format) in header["sections"].items():
+            column = view[start:start + length]
+            if data_format != "B":
+                column = column.cast(data_format)
+            self.views.append(column)
+            self.columns[name] = column
+        self.ids = self.columns["ids"]
+
+    def keys(self):
+        return [str(book_id) for book_id in self.ids.tolist()]
+
+    def __len__(self):
+        return self.book_count
+
+    def meta(self):
+        return pickle.loads(self.columns["meta"])
+
+    def year_entries(self):
+        return PairColumns(self.columns["year_numbers"], self.columns["year_ids"])
+
+    def cost_entries(self):
+        return PairColumns(self.columns["cost_numbers"], self.columns["cost_ids"])
+
+    def row_of(self, key):
+        # the IDs are in order, so a binary search finds the row
+        try:
+            book_id = int(key)
+        except ValueError:
+            return None
+        low = bisect.bisect_left(self.ids, book_id)
+        if low < self.book_count and self.ids[low] == book_id:
+            return low
+        return None
+
+    def book_at(self, row, book_class):
+        offsets = self.columns["offsets"]
+        heap = self.columns["heap"]
+        first = row * len(SLOTS)
+        name, author, tags, year_data, cost_data = (
+            bytes(heap[offsets[first + i]:offsets[first + i + 1]]) for i in range(len(SLOTS)))
+        tags = tags.decode("utf-8")
+        text_tags = tags.startswith(TEXT_TAGS)
+        book = book_class(name.decode("utf-8"), author.decode("utf-8"),
+                          join_value(self.columns["year_kinds"][row], self.columns["years"][row], year_data),
+                          join_value(self.columns["cost_kinds"][row], self.columns["costs"][row], cost_data),
+                          self.ids[row], () if text_tags or not tags else tags.split(TAG_SEPARATOR))
+        if text_tags:
+            # set afterwards, so a single string of tags isn't split into letters
+            book.genre_tags = tags[len(TEXT_TAGS):]
+        return book
+
+    def get(self, key, book_class):
+        row = self.row_of(key)
+        if row is None:
+            return None
+        return self.book_at(row, book_class)
+
+    def load_all(self, book_class):
+        return {str(self.ids[row]): self.book_at(row, book_class) for row in range(self.book_count)}
+
+    def close(self):
+        # every view has to be let go before the map can be closed
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        try:
+            self.map.close()
+        except BufferError:
+            # something still holds a slice of the file, the map closes once that's garbage collected
+            pass
+
+
+def open_snapshot(file_name, stamp, book_count=None):
+    """
+    opens the snapshot at file_name if it matches the store (same stamp, and the same number of books if book_count
+    is given). Returns None if it doesn't exist, is out of date, or can't be read, so the caller can rebuild instead
+    """
+    try:
+        snapshot = Snapshot(file_name)
+    except (OSError, ValueError, KeyError):
+        return None
+    if snapshot.stamp != stamp or (book_count is not None and snapshot.book_count != book_count):
+        snapshot.close()
+        return None
+    return snapshot
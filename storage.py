@@ -0,0 +1,532 @@
+import argparse
+import dbm
+import dbm.dumb
+import importlib
+import json
+import shelve
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from indexes import to_number
+
+
+# Library talks to its storage through a backend object, so the books can be kept in a shelf (like before) or in a
+# SQLite database. Every backend has the same functions:
+#   load_all(): returns a dictionary of ID (as a string) -> Book for every saved book
+#   keys(): returns the saved IDs
+#   get(key): returns one Book, or None if it isn't saved
+#   write(changed, deleted, counters=None): saves the books in the changed dictionary and removes the deleted IDs, all
+#       at once. counters (Library's ID counter and free IDs, a small dictionary) is saved with them if it's given
+#   load_counters(): returns the counters saved by the last write, or None if there aren't any
+#   clear(): removes every book at once
+#   reopen(): makes sure books written by another program since the store was opened can be seen
+#   sync(), close()
+
+
+def dbm_module(file_name):
+    # the dbm module shelve uses for file_name: the one that made it, or for a new file the first one dbm can import
+    kind = dbm.whichdb(file_name)
+    if kind:
+        return kind
+    for name in ("dbm.gnu", "dbm.ndbm", "dbm.dumb"):
+        try:
+            importlib.import_module(name)
+            return name
+        except ImportError:
+            continue
+    return None
+
+
+# the shelf keys that aren't books: the ID counters, a write that hasn't finished yet (see ShelveBackend.write())
+# and, for dbm.dumb, the deleted books whose keys are still in the .dir file. Books are kept under their IDs, which
+# are always numbers
+COUNTERS_KEY = "counters"
+PENDING_KEY = "pending"
+DELETED_KEY = "deleted"
+RESERVED_KEYS = (COUNTERS_KEY, PENDING_KEY, DELETED_KEY)
+
+
+class ShelveBackend:
+    """
+    the original storage, a shelve file where every book is pickled under its ID. With readonly=True the shelf is
+    opened for reading only, which is how readers of a shared library open it
+
+    shared: several programs have the shelf open at once (see sharing.py). gdbm locks the file itself, so a reader
+            couldn't open it while the writer has it open. The file locks in sharing.py already keep them apart, so
+            gdbm's own lock is turned off with the "u" flag
+
+    dbm.dumb (the fallback when there's no gdbm or ndbm, like on Windows) keeps its list of keys in a .dir file that
+    its sync() and every delete write out again in full, which makes a save slower the bigger the catalog. For it,
+    write() only ever adds to the file: a line for each record that moved (a later line for a key wins when the file
+    is read), and the keys of deleted books go in a list under DELETED_KEY that's left out of every read. The .dir
+    file is written out again when the shelf is opened for writing, closed, or has MAX_DELETED of them
+
+    deleted: the keys in DELETED_KEY
+    """
+    MAX_DELETED = 1000
+
+    def __init__(self, file_name, readonly=False, shared=False):
+        self.file_name = file_name
+        self.no_lock = "u" if shared and dbm_module(file_name) == "dbm.gnu" else ""
+        self.flag = ("r" if readonly else "c") + self.no_lock
+        self.shelf = shelve.open(file_name, flag=self.flag)
+        self.deleted = set(self.shelf.get(DELETED_KEY, ()))
+        if not readonly:
+            pending = self.shelf.get(PENDING_KEY)
+            if pending:
+                # the program stopped part way through a write, finish it
+                self.write_records(*pending)
+                self.shelf[PENDING_KEY] = None
+            if self.deleted:
+                self.forget_deleted()
+
+    def load_all(self):
+        books = dict(self.shelf)
+        for key in RESERVED_KEYS + tuple(self.deleted):
+            books.pop(key, None)
+        return books
+
+    def keys(self):
+        return [key for key in self.shelf.keys() if key not in RESERVED_KEYS and key not in self.deleted]
+
+    def get(self, key):
+        if key in RESERVED_KEYS or key in self.deleted:
+            return None
+        return self.shelf.get(key)
+
+    def __contains__(self, key):
+        return key not in RESERVED_KEYS and key not in self.deleted and key in self.shelf
+
+    def __len__(self):
+        hidden = RESERVED_KEYS + tuple(self.deleted)
+        return len(self.shelf) - sum(key in self.shelf for key in hidden)
+
+    def write(self, changed, deleted, counters=None):
+        """
+        saves the changed books and deletes the deleted ones. A shelf can only write one record at a time, so when
+        there's more than one they're first saved together under PENDING_KEY. If the program stops part way through,
+        opening the shelf for writing again finishes the write, so it's all saved or (if it stopped before that
+        record was) none of it
+        """
+        if len(changed) + len(deleted) < 2:
+            self.write_records(changed, deleted, counters)
+            return
+        self.write_records({PENDING_KEY: (dict(changed), list(deleted), counters)}, ())
+        self.sync()
+        self.write_records(changed, deleted, counters)
+        self.write_records({PENDING_KEY: None}, ())
+
+    def write_records(self, changed, deleted, counters=None):
+        records = dict(changed)
+        if counters is not None:
+            records[COUNTERS_KEY] = counters
+        database = self.dumb_database()
+        if database is None:
+            for key, record in records.items():
+                self.shelf[key] = record
+            for key in deleted:
+                if key in self.shelf:
+                    del self.shelf[key]
+            return
+
+        deleted = [key for key in deleted if key in self]
+        if deleted or self.deleted & set(records):
+            self.deleted.difference_update(records)
+            self.deleted.update(deleted)
+            records[DELETED_KEY] = sorted(self.deleted)
+        for key, record in records.items():
+            encoded = key.encode("utf-8")
+            if key in self.deleted:
+                # still in the .dir file, but not a book any more
+                database._index.pop(encoded, None)
+                continue
+            before = database._index.get(encoded)
+            self.shelf[key] = record
+            # a new key already got its line, a record that was rewritten somewhere else (or with another size)
+            # didn't, and the .dir file would point at the old one until the next full rewrite
+            after = database._index[encoded]
+            if before is not None and after != before:
+                database._addkey(encoded, after)
+        for key in deleted:
+            database._index.pop(key.encode("utf-8"), None)
+        if len(self.deleted) >= self.MAX_DELETED:
+            self.forget_deleted()
+
+    def dumb_database(self):
+        # the dbm.dumb database under the shelf, or None if it's another dbm module
+        database = self.shelf.dict
+        return database if isinstance(database, dbm.dumb._Database) else None
+
+    def forget_deleted(self):
+        # takes the deleted books out of the .dir file for good, with one full rewrite
+        for key in self.deleted:
+            if key in self.shelf:
+                del self.shelf.dict._index[key.encode("utf-8")]
+        self.deleted = set()
+        self.shelf[DELETED_KEY] = []
+        self.shelf.sync()
+
+    def load_counters(self):
+        return self.shelf.get(COUNTERS_KEY)
+
+    def clear(self):
+        # reopening with "n" starts a new empty shelf, much faster than deleting the records one by one
+        self.shelf.close()
+        self.shelf = shelve.open(self.file_name, flag="n" + self.no_lock)
+        self.deleted = set()
+
+    def reopen(self):
+        # some dbm modules only read the list of keys when the file is opened
+        self.shelf.close()
+        self.shelf = shelve.open(self.file_name, flag=self.flag)
+        self.deleted = set(self.shelf.get(DELETED_KEY, ()))
+
+    def sync(self):
+        # dbm.dumb's .dir file is already up to date after write(), its sync() would only write it out again
+        if self.dumb_database() is None:
+            self.shelf.sync()
+
+    def close(self):
+        if self.deleted and "r" not in self.flag:
+            self.forget_deleted()
+        self.shelf.close()
+
+
+class SQLiteBackend:
+    """
+    stores the books in a SQLite database, one row per book, with indexes on the searchable columns
+
+    genre tags also get their own table (one row per tag per book) and year_number and cost_number are the publish
+    date and cost turned into numbers, so the database can be filtered and counted with plain SQL by other tools.
+    The Library itself answers filters and statistics from its own indexes, which also see changes that haven't
+    been flushed yet. The database runs in WAL mode, so readers don't block the writer, and each write() is one
+    transaction
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            author TEXT,
+            publish_date,
+            cost,
+            genre_tags TEXT NOT NULL DEFAULT '[]',
+            year_number REAL,
+            cost_number REAL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS book_genres (
+            tag TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, book_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS books_name ON books (name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS books_author ON books (author COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS books_year ON books (year_number);
+        CREATE INDEX IF NOT EXISTS books_cost ON books (cost_number);
+        CREATE INDEX IF NOT EXISTS book_genres_book ON book_genres (book_id);
+    """
+
+    def __init__(self, file_name, book_class):
+        """
+        file_name: the database file
+        book_class: the class used to turn rows back into books (filetest.Book)
+        """
+        self.book_class = book_class
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def row_to_book(self, row):
+        book_id, name, author, publish_date, cost, genre_tags = row
+        return self.book_class(name, author, publish_date, cost, book_id, json.loads(genre_tags))
+
+    def load_all(self):
+        rows = self.connection.execute(
+            "SELECT id, name, author, publish_date, cost, genre_tags FROM books ORDER BY id")
+        return {str(row[0]): self.row_to_book(row) for row in rows}
+
+    def keys(self):
+        return [str(row[0]) for row in self.connection.execute("SELECT id FROM books ORDER BY id")]
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT id, name, author, publish_date, cost, genre_tags FROM books WHERE id = ?", (int(key),)).fetchone()
+        if row is None:
+            return None
+        return self.row_to_book(row)
+
+    def __contains__(self, key):
+        return self.connection.execute("SELECT 1 FROM books WHERE id = ?", (int(key),)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+
+    def write(self, changed, deleted, counters=None):
+        book_rows = []
+        genre_rows = []
+        for key, book in changed.items():
+            book_rows.append((int(key), book.name, book.author, book.publish_date, book.cost,
+                              json.dumps(book.genre_tags), to_number(book.publish_date), to_number(book.cost)))
+            if not isinstance(book.genre_tags, str):
+                genre_rows.extend((tag, int(key)) for tag in book.genre_tags)
+        touched = [(int(key),) for key in changed] + [(int(key),) for key in deleted]
+
+        # the with block makes all of this one transaction, so a crash never leaves half of it written
+        with self.connection:
+            self.connection.executemany("DELETE FROM book_genres WHERE book_id = ?", touched)
+            self.connection.executemany("DELETE FROM books WHERE id = ?", [(int(key),) for key in deleted])
+            self.connection.executemany("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", book_rows)
+            self.connection.executemany("INSERT OR IGNORE INTO book_genres VALUES (?, ?)", genre_rows)
+            if counters is not None:
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('counters', ?)", (json.dumps(counters),))
+
+    def load_counters(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'counters'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM book_genres")
+            self.connection.execute("DELETE FROM books")
+            self.connection.execute("DELETE FROM meta")
+
+    def reopen(self):
+        # every query already sees the latest committed data, this just ends any open read
+        self.connection.commit()
+
+    def sync(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class LazyInventory(MutableMapping):
+    """
+    stands in for Library.inventory when a library is opened with lazy=True. It works like the normal dictionary of
+    ID -> Book, but only the IDs are kept in memory. A book is read from the store the first time it's used and kept
+    in an LRU cache, so at most cache_size unchanged books stay in memory
+
+    cache: the books read recently, least recently used first
+    pending: books that were added or changed but haven't been written to the store yet. These can't be dropped
+            from memory, so they're kept apart from the cache until release() is called after a flush
+    hits, misses: how many lookups were answered from memory, and how many had to read the store
+    snapshot: an up to date snapshot.Snapshot to read books from instead of unpickling them from the store, or None.
+            Books changed since it was made (changed) are always read from the store
+    """
+    def __init__(self, store, cache_size=10000, snapshot=None, book_class=None):
+        self.store = store
+        self.cache_size = cache_size
+        self.snapshot = snapshot
+        self.book_class = book_class
+        # a dictionary instead of a set so the IDs keep their order, like a normal inventory
+        self.ids = dict.fromkeys(snapshot.keys() if snapshot is not None else store.keys())
+        self.changed = set()
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        # reader threads can look books up at the same time, the lock keeps the cache in one piece
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.pending:
+                self.hits += 1
+                return self.pending[key]
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            if key not in self.ids:
+                raise KeyError(key)
+            self.misses += 1
+            from_snapshot = self.snapshot is not None and key not in self.changed
+        book = self.snapshot.get(key, self.book_class) if from_snapshot else self.store.get(key)
+        if book is None:
+            raise KeyError(key)
+        if not from_snapshot and getattr(self.store, "ahead", False):
+            # the store of a shared library has changes that haven't been synced yet, so this might be newer than the
+            # version that's indexed. It isn't cached, so known() never hands it out as the indexed one
+            return book
+        with self.lock:
+            self.cache[key] = book
+            self.evict()
+        return book
+
+    def __setitem__(self, key, book):
+        with self.lock:
+            self.ids[key] = None
+            self.changed.add(key)
+            self.cache.pop(key, None)
+            self.pending[key] = book
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.ids[key]
+            self.cache.pop(key, None)
+            self.pending.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def hold(self, key):
+        # a cached book was changed in place, keep it in memory until it's written
+        with self.lock:
+            self.changed.add(key)
+            if key in self.cache:
+                self.pending[key] = self.cache.pop(key)
+
+    def known(self, key):
+        """
+        returns the book for key if it's in memory or can be read from the snapshot, without reading the store. A
+        reader of a shared library uses it to find the version of a book it indexed, after the writer has already
+        saved a newer one. None if there's no such copy
+        """
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if key in self.cache:
+                return self.cache[key]
+            if self.snapshot is None or key in self.changed:
+                return None
+        return self.snapshot.get(key, self.book_class)
+
+    def replace(self, key, book):
+        # a book another program saved, it's already in the store so it can go straight into the cache
+        with self.lock:
+            self.ids[key] = None
+            self.changed.add(key)
+            self.pending.pop(key, None)
+            self.cache[key] = book
+            self.cache.move_to_end(key)
+            self.evict()
+
+    def release(self):
+        # everything pending has been written to the store, so those books can be dropped from memory again
+        with self.lock:
+            self.cache.update(self.pending)
+            self.pending = {}
+            self.evict()
+
+    def evict(self):
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def cache_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "books": len(self.ids),
+            "cached": len(self.cache),
+            "pending": len(self.pending),
+            "cache_size": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+class InventoryView(MutableMapping):
+    """
+    a subset of an inventory that only keeps the IDs and looks the books up in the inventory when they're used.
+    Lazy libraries use it for filtered_inventory and search results, so those never hold every book in memory
+    """
+    def __init__(self, inventory, ids=()):
+        self.inventory = inventory
+        self.ids = dict.fromkeys(ids)
+
+    def __getitem__(self, key):
+        if key not in self.ids:
+            raise KeyError(key)
+        return self.inventory[key]
+
+    def __setitem__(self, key, book):
+        # the book is always the one in inventory already, only its ID has to be remembered
+        self.ids[key] = None
+
+    def __delitem__(self, key):
+        del self.ids[key]
+
+    def pop(self, key, *default):
+        # forgets the ID without needing the book, which might already be gone from inventory
+        if key not in self.ids:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self.ids[key]
+        return self.inventory.get(key, *default)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def open_backend(file_name, backend, book_class, readonly=False, shared=False):
+    """
+    backend: "shelve", "sqlite", or a backend object that is already open (returned as is)
+    readonly: open a shelf for reading only
+    shared: the shelf is shared with other programs, see ShelveBackend
+    """
+    if backend == "shelve":
+        return ShelveBackend(file_name, readonly, shared)
+    if backend == "sqlite":
+        return SQLiteBackend(file_name, book_class)
+    if isinstance(backend, str):
+        raise ValueError(f"unknown storage backend: {backend}")
+    return backend
+
+
+def migrate_shelf(shelf_name, database_name, batch_size=10000):
+    """
+    copies every book from a shelf into a SQLite database, writing batch_size books per transaction.
+    returns how many books were copied
+    """
+    from filetest import Book
+
+    source = ShelveBackend(shelf_name)
+    target = SQLiteBackend(database_name, Book)
+    copied = 0
+    batch = {}
+    try:
+        for key in source.keys():
+            batch[key] = source.get(key)
+            if len(batch) >= batch_size:
+                target.write(batch, ())
+                copied += len(batch)
+                batch = {}
+        target.write(batch, (), source.load_counters())
+        copied += len(batch)
+    finally:
+        source.close()
+        target.close()
+    return copied
+
+
+if __name__ == "__main__":
+    # python storage.py migrate books books.db
+    parser = argparse.ArgumentParser(description="Library storage tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="copy a shelf into a SQLite database")
+    migrate.add_argument("shelf", help="the shelf file name, as passed to Library (e.g. books)")
+    migrate.add_argument("database", help="the SQLite file to create or update (e.g. books.db)")
+    arguments = parser.parse_args()
+
+    count = migrate_shelf(arguments.shelf, arguments.database)
+    print(f"copied {count} books from {arguments.shelf} to {arguments.database}")
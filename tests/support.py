@@ -0,0 +1,64 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from filetest import Library, build_indexes
+
+
+# things the tests share. Library prints a line for most calls, quiet() keeps that out of the test output
+
+
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def index_state(genre_index, text_index, year_index, cost_index, stats):
+    # everything the indexes know, in a form that can be compared with ==
+    return {
+        "genres": genre_index.tags,
+        "text": (text_index.postings, text_index.values),
+        "years": list(year_index.entries),
+        "costs": list(cost_index.entries),
+        "titles": stats.titles,
+        "genre_counts": stats.genres,
+        "genre_costs": stats.cost_summary(),
+        "book_count": stats.book_count
+    }
+
+
+class LibraryTestCase(unittest.TestCase):
+    """
+    gives every test a temporary folder, and a way to open libraries in it that get closed afterwards
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.file_name = os.path.join(self.directory, "books")
+
+    def open_library(self, **options):
+        with quiet():
+            library = Library(options.pop("file_name", self.file_name), **options)
+        self.addCleanup(self.close_library, library)
+        return library
+
+    @staticmethod
+    def close_library(library):
+        # closing twice is harmless for the store, but the tests close some libraries themselves
+        if not getattr(library, "closed_by_test", False):
+            with quiet():
+                library.close()
+
+    def close(self, library):
+        with quiet():
+            library.close()
+        library.closed_by_test = True
+
+    def assertIndexesMatch(self, library):
+        # the indexes kept up to date change by change have to match ones built from scratch
+        expected = index_state(*build_indexes(library.inventory.values()))
+        actual = index_state(library.genre_index, library.text_index, library.year_index, library.cost_index,
+                             library.stats)
+        self.assertEqual(actual, expected)
@@ -0,0 +1,198 @@
+import os
+
+from filetest import parse_cost, parse_publish_date
+from tests.support import LibraryTestCase, quiet
+
+
+class IDCounterTest(LibraryTestCase):
+
+    def crash(self, library):
+        # stops using a library without close(), so no snapshot gets saved
+        library.store.close()
+        library.closed_by_test = True
+
+    def test_counter_survives_a_crash(self):
+        for backend in ("shelve", "sqlite"):
+            with self.subTest(backend=backend):
+                file_name = f"{self.file_name}-{backend}"
+                library = self.open_library(file_name=file_name, backend=backend)
+                with quiet():
+                    library.create_sample()
+                self.close(library)
+
+                library = self.open_library(file_name=file_name, backend=backend)
+                with quiet():
+                    library.delete_book(7)
+                self.crash(library)
+
+                library = self.open_library(file_name=file_name, backend=backend)
+                self.assertIsNone(library.snapshot)
+                with quiet():
+                    self.assertEqual(library.add_book("New", "Someone", 2000, 5), 8)
+
+    def test_free_IDs_survive_a_crash(self):
+        library = self.open_library(reuse_IDs=True)
+        with quiet():
+            library.create_sample()
+            library.delete_book(3)
+        self.crash(library)
+
+        library = self.open_library(reuse_IDs=True)
+        with quiet():
+            self.assertEqual(library.add_book("New", "Someone", 2000, 5), 3)
+            self.assertEqual(library.add_book("Newer", "Someone", 2000, 5), 8)
+
+
+class ExportTest(LibraryTestCase):
+
+    def test_csv_round_trip(self):
+        library = self.open_library()
+        tags = ["a;b", "back\\slash", "ends with\\", "plain"]
+        with quiet():
+            library.add_book("Title, with comma", "Author", 1990, 3.5, tags)
+            library.export(self.file_name + ".csv")
+        copy = self.open_library(file_name=self.file_name + "-copy")
+        with quiet():
+            report = copy.import_books(self.file_name + ".csv")
+        self.assertEqual(report["rejected"], [])
+        self.assertEqual(copy.inventory["0"].get_stats(), library.inventory["0"].get_stats())
+
+    def test_failed_export_leaves_nothing_behind(self):
+        library = self.open_library()
+        with quiet():
+            library.create_sample()
+
+        def broken(book):
+            raise RuntimeError("broken filter")
+
+        with self.assertRaises(RuntimeError), quiet():
+            library.export(self.file_name + ".jsonl", filter=broken)
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if "jsonl" in name), [])
+
+
+class FilterTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.library = self.open_library()
+        with quiet():
+            self.library.create_sample()
+
+    def filtered(self, **filters):
+        self.library.apply_filter(**filters)
+        return sorted(self.library.filtered_inventory, key=int)
+
+    def years(self, low, high):
+        return sorted((key for key, book in self.library.inventory.items() if low <= book.publish_date <= high),
+                      key=int)
+
+    def test_bounds_on_one_field_combine(self):
+        self.assertEqual(self.filtered(publish=1997, year_max=1950), [])
+        self.assertEqual(self.filtered(year_between=(1800, 2000), year_max=1900), self.years(1800, 1900))
+        self.assertEqual(self.filtered(year_min=1900, year_between=(1800, 1950)), self.years(1900, 1950))
+        self.assertEqual(self.filtered(year_min="1900", year_max="1950"), self.years(1900, 1950))
+
+    def test_bad_bound_raises(self):
+        before = self.filtered(genre_tags=["fantasy"])
+        for filters in ({"year_min": "soon"}, {"cost_max": float("nan")}, {"cost_between": (1, "lots")}):
+            with self.subTest(filters=filters), self.assertRaises(ValueError):
+                self.library.apply_filter(**filters)
+        # a filter that raised leaves the last result alone
+        self.assertEqual(sorted(self.library.filtered_inventory, key=int), before)
+
+    def test_search_finds_years_and_costs(self):
+        book = self.library.inventory["3"]
+        self.assertIn("3", self.library.search(str(book.publish_date), fields=("publish_date",)))
+        self.assertIn("3", self.library.search(str(book.cost), fields=("cost",)))
+
+
+class ImportTest(LibraryTestCase):
+
+    def test_bad_rows_are_rejected(self):
+        path = self.file_name + ".jsonl"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"name": "Good", "author": "A", "publish_date": 1990, "cost": 3, "genre_tags": ["x"]}\n'
+                       '{"name": "Broken",\n'
+                       '[1, 2, 3]\n'
+                       '{"name": "Tags", "author": "A", "genre_tags": 5}\n'
+                       '{"name": "Tags", "author": "A", "genre_tags": [1]}\n'
+                       '{"name": "Year", "author": "A", "publish_date": "soon"}\n'
+                       '{"name": "Also Good", "author": "B"}\n')
+        library = self.open_library()
+        with quiet():
+            report = library.import_books(path)
+        self.assertEqual(report["imported"], 2)
+        self.assertEqual(len(report["rejected"]), 5)
+        self.assertEqual(sorted(book.name for book in library.inventory.values()), ["Also Good", "Good"])
+        self.assertIndexesMatch(library)
+
+
+class NaNTest(LibraryTestCase):
+
+    def test_nan_cost_stays_out_of_the_indexes(self):
+        library = self.open_library()
+        costs = [10, "nan", 20, 30, 5, 40, 15, float("nan")]
+        with quiet():
+            for cost in costs:
+                library.add_book(f"Book {cost}", "Someone", 2000, cost, ["mystery"])
+        self.assertIndexesMatch(library)
+
+        def filtered(**filters):
+            library.apply_filter(**filters)
+            return sorted(library.inventory[key].cost for key in library.filtered_inventory)
+
+        self.assertEqual(filtered(cost_min=12), [15, 20, 30, 40])
+        self.assertEqual(filtered(cost_max=25), [5, 10, 15, 20])
+        self.assertEqual(library.stats_genre_costs()["mystery"]["count"], 6)
+
+        with quiet():
+            self.assertTrue(library.delete_book(1))
+            self.assertTrue(library.delete_book(7))
+        self.assertIndexesMatch(library)
+        self.close(library)
+        self.assertEqual(len(self.open_library().inventory), 6)
+
+    def test_parsers_reject_nan_and_inf(self):
+        for value in ("nan", "inf", "-inf", float("nan"), float("inf")):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_cost(value)
+                with self.assertRaises(ValueError):
+                    parse_publish_date(value)
+
+
+class FailedChangeTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.library = self.open_library()
+        with quiet():
+            self.library.create_sample()
+        self.library.apply_filter(genre_tags=["fantasy"])
+        self.filtered_tags = self.library.stats_tags(use_filter=True)
+
+    def break_cost_index(self):
+        # the genre and text indexes get updated first, then this one fails
+        def broken(book):
+            raise KeyError("broken")
+        self.library.cost_index.remove = broken
+
+    def assertUnchanged(self, key, stats):
+        self.assertEqual(self.library.inventory[key].get_stats(), stats)
+        self.assertEqual(self.library.stats_tags(use_filter=True), self.filtered_tags)
+        self.assertIndexesMatch(self.library)
+
+    def test_failed_delete_keeps_the_book(self):
+        stats = self.library.inventory["1"].get_stats()
+        self.break_cost_index()
+        with quiet():
+            self.assertFalse(self.library.delete_book(1))
+        self.assertUnchanged("1", stats)
+        self.assertEqual(self.library.dirty_keys, set())
+
+    def test_failed_edit_keeps_the_book(self):
+        stats = self.library.inventory["2"].get_stats()
+        self.break_cost_index()
+        with self.assertRaises(KeyError), quiet():
+            self.library.edit_book(2, name="Renamed", cost=1)
+        self.assertUnchanged("2", stats)
@@ -0,0 +1,97 @@
+import asyncio
+
+from loadtest import send
+from server import LibraryServer
+from tests.support import LibraryTestCase, quiet
+
+
+class LibraryServerTest(LibraryTestCase):
+    """
+    runs a LibraryServer on a free port and talks to it over one keep-alive connection, like a client would
+    """
+    def setUp(self):
+        super().setUp()
+        self.library = self.open_library(access="writer")
+        with quiet():
+            self.library.create_sample()
+            self.library.edit_book(2, publish_date="n/a")
+        self.server = LibraryServer(self.library)
+
+    def requests(self, *requests):
+        # sends (method, path, body) requests one after the other, returns their (status, body) answers
+        async def run():
+            self.server.writes = asyncio.Queue()
+            write_loop = asyncio.create_task(self.server.write_loop())
+            listener = await asyncio.start_server(self.server.handle_connection, "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                return [await send(reader, writer, "127.0.0.1", *request) for request in requests]
+            finally:
+                writer.close()
+                await writer.wait_closed()
+                # give the server's side of the connection a moment to see that it was closed
+                await asyncio.sleep(0.05)
+                listener.close()
+                await listener.wait_closed()
+                write_loop.cancel()
+
+        with quiet():
+            try:
+                return asyncio.run(run())
+            finally:
+                self.server.writer.shutdown(wait=True)
+                self.server.readers.shutdown(wait=True)
+
+    def test_patch_sets_only_the_fields_sent(self):
+        answers = self.requests(("PATCH", "/books/1", {"cost": 0}),
+                                ("PATCH", "/books/1", {"genre_tags": []}),
+                                ("PATCH", "/books/2", {"cost": 3}),
+                                ("PATCH", "/books/3", {"publish_date": "soon"}),
+                                ("PATCH", "/books/3", {"name": " "}),
+                                ("PATCH", "/books/3", {"pages": 12}),
+                                ("PATCH", "/books/99", {"cost": 1}))
+        statuses = [status for status, body in answers]
+        self.assertEqual(statuses, [200, 200, 200, 400, 400, 400, 404])
+        self.assertEqual(answers[1][1]["cost"], 0)
+        self.assertEqual(answers[1][1]["genre_tags"], [])
+        self.assertEqual(answers[2][1]["publish_date"], "n/a")
+        self.assertEqual(answers[2][1]["cost"], 3)
+        self.assertEqual(self.library.inventory["3"].publish_date, 1997)
+        self.assertIndexesMatch(self.library)
+
+    def test_batch(self):
+        flushes = self.library.flush_count
+        status, body = self.requests(("POST", "/batch", {"requests": [
+            {"method": "POST", "path": "/books", "body": {"name": "One", "author": "A", "publish_date": 1990,
+                                                          "cost": 5, "genre_tags": ["mystery"]}},
+            {"method": "POST", "path": "/books", "body": {"name": "Two", "author": "B"}},
+            {"method": "PATCH", "path": "/books/4", "body": {"cost": 11}},
+            {"method": "DELETE", "path": "/books/5"},
+            {"method": "POST", "path": "/books", "body": {"author": "No Name"}},
+            {"method": "GET", "path": "/books/0"}
+        ]}))[0]
+        self.assertEqual(status, 200)
+        self.assertEqual([response["status"] for response in body["responses"]], [201, 201, 200, 200, 400, 200])
+        # every change in the batch went out in the same flush
+        self.assertEqual(self.library.flush_count, flushes + 1)
+        self.assertEqual(self.library.dirty_keys, set())
+        self.assertEqual(self.library.inventory["4"].cost, 11)
+        self.assertNotIn("5", self.library.inventory)
+        self.assertIndexesMatch(self.library)
+
+    def test_reads(self):
+        answers = self.requests(("GET", "/search?q=1997", None),
+                                ("GET", "/filter?genre=fantasy&year_max=1950", None),
+                                ("GET", "/filter?year_min=1900&year_max=1800", None),
+                                ("GET", "/filter?year_min=soon", None),
+                                ("GET", "/stats", None),
+                                ("GET", "/books/3", None))
+        self.assertEqual([status for status, body in answers], [200, 200, 200, 400, 200, 200])
+        self.assertEqual([book["ID"] for book in answers[0][1]["books"]], [3])
+        self.assertEqual([book["ID"] for book in answers[1][1]["books"]],
+                         [int(key) for key in self.library.match_filter(genre_tags=["fantasy"], year_max=1950)])
+        self.assertEqual(answers[2][1]["count"], 0)
+        self.assertEqual(answers[4][1]["book_count"], 8)
+        # /filter doesn't touch the library's own filtered books
+        self.assertEqual(len(self.library.filtered_inventory), 0)
@@ -0,0 +1,133 @@
+import os
+import threading
+
+from sharing import ChangeJournal, LibraryLockedError
+from tests.support import LibraryTestCase, quiet
+
+
+class ChangeJournalTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, "books.changes")
+        self.writer = ChangeJournal(self.path)
+        self.writer.MAX_SIZE = 40
+        self.reader = ChangeJournal(self.path)
+        self.reader.start()
+
+    def test_reader_gets_new_keys(self):
+        self.writer.append(["1", "2"])
+        self.assertEqual(self.reader.read_new(), {"1", "2"})
+        self.assertEqual(self.reader.read_new(), set())
+        self.writer.append((), everything=True)
+        self.assertIsNone(self.reader.read_new())
+
+    def test_rotation(self):
+        self.writer.append(["1"])
+        self.assertEqual(self.reader.read_new(), {"1"})
+        inode = os.stat(self.path).st_ino
+        # enough to go past MAX_SIZE, so the writer starts a new journal
+        self.writer.append([str(key) for key in range(10, 20)])
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        # a reader that had read everything before the new journal only gets the new changes
+        self.assertEqual(self.reader.read_new(), {str(key) for key in range(10, 20)})
+
+    def test_rotation_after_falling_behind(self):
+        self.writer.append(["1"])
+        self.writer.append([str(key) for key in range(10, 20)])
+        self.writer.append([str(key) for key in range(20, 30)])
+        # the changes in the journal that was replaced are lost, so everything has to be reloaded
+        self.assertIsNone(self.reader.read_new())
+        self.writer.append(["2"])
+        self.assertEqual(self.reader.read_new(), {"2"})
+
+
+class SyncChangesTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writer = self.open_library(access="writer")
+        with quiet():
+            self.writer.create_sample()
+
+    def assertInSync(self, reader):
+        self.assertEqual(sorted(reader.inventory), sorted(self.writer.inventory))
+        for key in self.writer.inventory:
+            self.assertEqual(reader.inventory[key].get_stats(), self.writer.inventory[key].get_stats())
+        self.assertIndexesMatch(reader)
+
+    def test_reader_picks_up_changes(self):
+        for lazy, deleted in ((False, 2), (True, 3)):
+            with self.subTest(lazy=lazy):
+                reader = self.open_library(access="reader", lazy=lazy)
+                version = reader.version
+                with quiet():
+                    self.writer.edit_book(1, cost=999, genre=["poetry"])
+                    self.writer.delete_book(deleted)
+                    new_id = self.writer.add_book("New One", "Someone", 2001, 5, ["horror"])
+                    changed = reader.sync_changes()
+                self.assertEqual(changed, {"1", str(deleted), str(new_id)})
+                self.assertEqual(reader.changes_since(version), changed)
+                self.assertInSync(reader)
+                with quiet():
+                    self.assertEqual(reader.sync_changes(), set())
+
+    def test_reader_reloads_after_delete_all(self):
+        reader = self.open_library(access="reader")
+        with quiet():
+            self.writer.delete_all_books()
+            self.writer.add_book("Only One", "Someone", 1999, 10, ["mystery"])
+            self.assertIsNone(reader.sync_changes())
+        self.assertInSync(reader)
+
+    def test_reader_survives_journal_rotation(self):
+        reader = self.open_library(access="reader")
+        self.writer.sharing.journal.MAX_SIZE = 60
+        inode = os.stat(self.writer.sharing.journal.path).st_ino
+        with quiet():
+            for cost in range(10):
+                self.writer.edit_book(cost % 8, cost=cost)
+            reader.sync_changes()
+        self.assertNotEqual(os.stat(self.writer.sharing.journal.path).st_ino, inode)
+        self.assertInSync(reader)
+
+    def test_load_changes_beside_store_reads(self):
+        # load_changes() on one thread, the lazy inventory reading the store on another: the two used to take the
+        # thread lock and the file lock in opposite orders, and could each wait for the other
+        reader = self.open_library(access="reader", lazy=True)
+        keys = list(reader.store.keys())
+        stop = threading.Event()
+
+        def read_books():
+            while not stop.is_set():
+                for key in keys:
+                    reader.store.get(key)
+
+        thread = threading.Thread(target=read_books, daemon=True)
+        thread.start()
+        done = threading.Event()
+
+        def load_changes():
+            with quiet():
+                for cost in range(200):
+                    self.writer.edit_book(1, cost=cost)
+                    reader.load_changes()
+            done.set()
+
+        loader = threading.Thread(target=load_changes, daemon=True)
+        loader.start()
+        finished = done.wait(20)
+        stop.set()
+        self.assertTrue(finished, "load_changes() and the store reads deadlocked")
+        thread.join(5)
+        loader.join(5)
+
+    def test_reader_cannot_write(self):
+        reader = self.open_library(access="reader")
+        with self.assertRaises(PermissionError):
+            reader.add_book("Nope", "Nobody", 2000, 1)
+
+    def test_second_writer_is_refused(self):
+        with self.assertRaises(LibraryLockedError):
+            with quiet():
+                self.open_library(access="writer")
@@ -0,0 +1,58 @@
+import os
+
+from filetest import Book
+from storage import open_backend
+from tests.support import LibraryTestCase, quiet
+
+
+class SnapshotTest(LibraryTestCase):
+
+    def make_library(self):
+        library = self.open_library()
+        with quiet():
+            library.create_sample()
+            library.delete_book(2)
+            library.edit_book(3, cost=42)
+        self.close(library)
+        return library
+
+    def test_round_trip(self):
+        before = self.make_library()
+        self.assertTrue(os.path.exists(before.snapshot_file))
+
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                after = self.open_library(lazy=lazy)
+                self.assertIsNotNone(after.snapshot)
+                self.assertEqual(list(after.inventory), list(before.inventory))
+                for key in before.inventory:
+                    self.assertEqual(after.inventory[key].get_stats(), before.inventory[key].get_stats())
+                self.assertEqual(after.current_ID, before.current_ID)
+                self.assertEqual(after.stats_tags(), before.stats_tags())
+                self.assertEqual(after.stats_genre_costs(), before.stats_genre_costs())
+                self.assertEqual(list(after.search("the")), list(before.search("the")))
+                self.assertIndexesMatch(after)
+                self.close(after)
+
+    def test_stale_snapshot_is_not_used(self):
+        self.make_library()
+        # change the shelf behind the snapshot's back, like a program that crashed before close()
+        store = open_backend(self.file_name, "shelve", Book)
+        store.write({"99": Book("Written Later", "Somebody", 2020, 7, 99, ["poetry"])}, ())
+        store.close()
+
+        library = self.open_library()
+        self.assertIsNone(library.snapshot)
+        self.assertIn("99", library.inventory)
+        self.assertEqual(list(library.search("written later")), ["99"])
+        self.assertIndexesMatch(library)
+
+    def test_broken_snapshot_is_not_used(self):
+        before = self.make_library()
+        with open(before.snapshot_file, "r+b") as file:
+            file.write(b"garbage")
+
+        library = self.open_library()
+        self.assertIsNone(library.snapshot)
+        self.assertEqual(sorted(library.inventory), sorted(before.inventory))
+        self.assertIndexesMatch(library)
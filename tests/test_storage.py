@@ -0,0 +1,65 @@
+from filetest import Book
+from storage import PENDING_KEY, ShelveBackend
+from tests.support import LibraryTestCase
+
+
+class DumbShelfTest(LibraryTestCase):
+
+    def open_store(self, readonly=False):
+        store = ShelveBackend(self.file_name, readonly=readonly)
+        self.addCleanup(store.close)
+        if store.dumb_database() is None:
+            self.skipTest("the shelf isn't a dbm.dumb one here")
+        return store
+
+    def test_dir_file_only_grows(self):
+        store = self.open_store()
+        books = {str(i): Book("Book %d" % i, "Somebody", 2000, i, i, ["poetry"]) for i in range(1, 6)}
+        store.write(books, (), {"current": 5})
+        store.write({"2": Book("A Much Longer Title Than Before", "Somebody", 2000, 2, 2, ["poetry"])}, ["3", "4"])
+        store.write({"4": Book("Back Again", "Somebody", 2000, 4, 4, ["poetry"])}, ["5"])
+        with open(self.file_name + ".dir") as file:
+            lines = file.read().splitlines()
+
+        # a reader opened now sees what a crash would leave behind
+        reader = self.open_store(readonly=True)
+        self.assertEqual(sorted(reader.keys()), ["1", "2", "4"])
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader.get("2").name, "A Much Longer Title Than Before")
+        self.assertEqual(reader.get("4").name, "Back Again")
+        self.assertIsNone(reader.get("3"))
+        self.assertNotIn("5", reader)
+        self.assertEqual(reader.load_counters(), {"current": 5})
+        reader.close()
+
+        store.close()
+        with open(self.file_name + ".dir") as file:
+            self.assertLess(len(file.read().splitlines()), len(lines))
+        store = self.open_store()
+        self.assertEqual(sorted(store.load_all()), ["1", "2", "4"])
+        self.assertEqual(store.deleted, set())
+
+
+class PendingWriteTest(LibraryTestCase):
+
+    def test_unfinished_write_is_finished_on_open(self):
+        store = ShelveBackend(self.file_name)
+        books = {str(i): Book("Book %d" % i, "Somebody", 2000, i, i, ["poetry"]) for i in range(1, 4)}
+        store.write(books, (), {"current_ID": 4, "free_IDs": []})
+
+        # a program that stopped right after the first record of a write
+        changed = {"1": Book("Changed", "Somebody", 2000, 1, 1, ["poetry"]), "4": Book("New", "Somebody", 2000, 4, 4)}
+        store.write_records({PENDING_KEY: (changed, ["2"], {"current_ID": 5, "free_IDs": []})}, ())
+        store.write_records({"1": changed["1"]}, ())
+        store.close()
+
+        reader = ShelveBackend(self.file_name, readonly=True)
+        self.assertNotIn(PENDING_KEY, reader.keys())
+        reader.close()
+
+        store = ShelveBackend(self.file_name)
+        self.addCleanup(store.close)
+        self.assertEqual(sorted(store.keys()), ["1", "3", "4"])
+        self.assertEqual(store.get("1").name, "Changed")
+        self.assertEqual(store.load_counters(), {"current_ID": 5, "free_IDs": []})
+        self.assertIsNone(store.shelf[PENDING_KEY])
@@ -0,0 +1,113 @@
+from tests.support import LibraryTestCase, quiet
+
+
+class Boom(Exception):
+    pass
+
+
+class TransactionTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.library = self.open_library(reuse_IDs=True)
+        with quiet():
+            self.library.create_sample()
+        self.before = self.books(self.library)
+
+    @staticmethod
+    def books(library):
+        return {key: library.inventory[key].get_stats() for key in library.inventory}
+
+    def assertUnchanged(self, library):
+        self.assertEqual(self.books(library), self.before)
+        self.assertIndexesMatch(library)
+
+    def test_rollback_puts_everything_back(self):
+        library = self.library
+        current_ID = library.current_ID
+        version = library.version
+        library.apply_filter(genre_tags=["fantasy"])
+        filtered = dict(library.stats_tags(use_filter=True))
+        with self.assertRaises(Boom), quiet():
+            with library.transaction():
+                library.add_book("Added", "Someone", 2001, 5, ["horror"])
+                library.edit_book(1, name="Renamed", cost=1, genre=["poetry"])
+                library.delete_book(2)
+                library.delete_books([3, 4])
+                raise Boom()
+        self.assertUnchanged(library)
+        self.assertEqual(library.current_ID, current_ID)
+        self.assertEqual(library.version, version)
+        self.assertEqual(library.stats_tags(use_filter=True), filtered)
+        self.assertEqual(library.dirty_keys, set())
+
+        # nothing reached the shelf either
+        self.close(library)
+        self.assertUnchanged(self.open_library())
+
+    def test_commit_writes_once(self):
+        library = self.library
+        flushes = library.flush_count
+        with quiet(), library.transaction():
+            library.edit_book(1, cost=1)
+            library.delete_book(2)
+        self.assertEqual(library.flush_count, flushes + 1)
+        self.assertIndexesMatch(library)
+
+    def test_nested_transaction_rolls_back_with_the_outer_one(self):
+        library = self.library
+        with self.assertRaises(Boom), quiet():
+            with library.transaction():
+                with library.transaction():
+                    library.edit_book(5, author="Someone Else")
+                library.delete_book(6)
+                raise Boom()
+        self.assertUnchanged(library)
+
+    def test_failed_import_rolls_back(self):
+        library = self.library
+
+        def rows():
+            yield {"name": "First", "author": "Someone", "publish_date": 2000, "cost": 3, "genre_tags": ["mystery"]}
+            raise OSError("the file went away")
+
+        with self.assertRaises(OSError), quiet():
+            library.import_books(rows())
+        self.assertUnchanged(library)
+
+    def test_lazy_rollback(self):
+        library = self.open_library(file_name=self.file_name + "-lazy", lazy=True, cache_size=2)
+        with quiet():
+            library.create_sample()
+        self.before = self.books(library)
+        with self.assertRaises(Boom), quiet():
+            with library.transaction():
+                library.delete_books(list(library.inventory)[:4])
+                library.edit_book(7, cost=0)
+                raise Boom()
+        self.assertUnchanged(library)
+
+    def test_failed_commit_rolls_back(self):
+        library = self.library
+        write = library.store.write
+
+        def half_write(changed, deleted, counters=None):
+            # writes one of the records and then fails, like a full disk
+            key = sorted(changed)[0]
+            write({key: changed[key]}, (), counters)
+            raise OSError("disk full")
+
+        library.store.write = half_write
+        with self.assertRaises(OSError), quiet():
+            with library.transaction():
+                library.edit_book(1, cost=1)
+                library.edit_book(2, cost=2)
+                library.delete_book(3)
+        self.assertUnchanged(library)
+        self.assertEqual(library.dirty_keys, {"1", "2", "3"})
+
+        # the next flush puts the half written books back the way they were
+        library.store.write = write
+        library.flush()
+        self.close(library)
+        self.assertUnchanged(self.open_library())
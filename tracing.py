@@ -0,0 +1,93 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# records how long parts of the app take as Chrome trace events. Turn it on with python main.py --trace trace.json,
+# then open the file in chrome://tracing or https://ui.perfetto.dev to see every click on a timeline.
+# When tracing is off, span() and traced() do nothing apart from checking that it's off
+
+events = None
+file_name = None
+started = 0.0
+thread_names = {}
+lock = threading.Lock()
+
+
+def enabled():
+    return events is not None
+
+
+def start(trace_file):
+    """
+    starts recording spans, they are written to trace_file by save() (which also runs when the program exits)
+    """
+    global events, file_name, started
+    events = []
+    file_name = trace_file
+    started = time.perf_counter()
+    atexit.register(save)
+
+
+def now():
+    # trace events count in microseconds
+    return (time.perf_counter() - started) * 1e6
+
+
+def add_event(event):
+    thread = threading.current_thread()
+    event["pid"] = os.getpid()
+    event["tid"] = thread.ident
+    with lock:
+        if thread.ident not in thread_names:
+            thread_names[thread.ident] = thread.name
+        events.append(event)
+
+
+@contextmanager
+def span(name, category="app", **args):
+    """
+    with span("load_data"): ... records how long the block took, args are shown next to it in the viewer
+    """
+    if events is None:
+        yield
+        return
+    begin = now()
+    try:
+        yield
+    finally:
+        add_event({"name": name, "cat": category, "ph": "X", "ts": begin, "dur": now() - begin, "args": args})
+
+
+def traced(name, category="app"):
+    """
+    decorator version of span(), e.g. @traced("App.show_frame")
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if events is None:
+                return function(*args, **kwargs)
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save():
+    """
+    writes everything recorded so far to the trace file
+    """
+    if events is None:
+        return
+    with lock:
+        recorded = list(events)
+        names = dict(thread_names)
+    metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                for ident, name in names.items()]
+    with open(file_name, "w") as file:
+        json.dump({"traceEvents": metadata + recorded, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,176 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import tracing
+
+
+class ReadWriteLock:
+    """
+    lets any number of readers in at once, or a single writer on its own. Writers that are waiting go first, so a
+    steady stream of reads can't keep a write waiting forever
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def reading(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class LibraryWorker:
+    """
+    runs Library calls on background threads so the Tk window never freezes while the shelf is being written
+
+    every change (add_book, edit_book, delete_book, import_books, ...) goes to a single writer thread, one after the
+    other. Slow reads can go to a small pool of reader threads. When a call finishes, its result is put on a queue
+    and poll() (which Tk runs every POLL_MS with after()) hands it to the callback on the Tk thread, so callbacks
+    can touch widgets like normal
+
+    the writer only holds the lock while it changes books in memory. Writing them to disk (flush()) happens after
+    the lock is let go, and a change that has to read the disk first (like sync_changes(), see write()) does that
+    before the lock is taken, so the pages can keep reading the library (with read_now()) while the disk is busy
+    """
+    POLL_MS = 50
+
+    def __init__(self, library, root, readers=1, on_busy=None):
+        """
+        library: the Library to run calls on
+        root: any Tk widget, used for after()
+        readers: how many reader threads to use, 0 sends reads to the writer thread instead
+        on_busy: optional function called on the Tk thread with the number of unfinished calls whenever it changes,
+                used to show progress
+        """
+        self.library = library
+        self.root = root
+        self.on_busy = on_busy
+        self.lock = ReadWriteLock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library-writer")
+        if readers:
+            self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="library-reader")
+        else:
+            self.readers = self.writer
+        self.results = queue.Queue()
+        self.pending = 0
+        self.closed = False
+
+        # the writer thread flushes after every call instead
+        self.library.autoflush = False
+        self.root.after(self.POLL_MS, self.poll)
+
+    def write(self, method, *args, prepare=None, callback=None, on_error=None, **kwargs):
+        """
+        runs library.method(*args, **kwargs) on the writer thread and then writes the changes to disk.
+        callback(result) or on_error(error) is called on the Tk thread afterwards
+        prepare: the name of a Library method that reads what the change needs from disk without changing anything
+                (like load_changes() for apply_changes()). It runs first, without the lock, and what it returns is
+                passed to method before args
+        """
+        self.started()
+        return self.writer.submit(self.run_write, method, args, kwargs, prepare, callback, on_error)
+
+    def read(self, method, *args, callback=None, on_error=None, **kwargs):
+        """
+        runs library.method(*args, **kwargs) on a reader thread, callback(result) gets called on the Tk thread
+        """
+        self.started()
+        return self.readers.submit(self.run_read, method, args, kwargs, callback, on_error)
+
+    def read_now(self, method, *args, **kwargs):
+        """
+        runs a quick read straight away on the calling thread. It only has to wait if the writer is in the middle
+        of changing books in memory. Flushes and the disk reads done by prepare (see write()) don't hold the lock,
+        but a change to a lazy library still reads the books it changes from the store while it does
+        """
+        with self.lock.reading():
+            return getattr(self.library, method)(*args, **kwargs)
+
+    def run_write(self, method, args, kwargs, prepare, callback, on_error):
+        try:
+            if prepare:
+                # only the writer thread changes the library, so nothing changes it while this runs
+                with tracing.span(f"Library.{prepare}", "library"):
+                    args = (getattr(self.library, prepare)(),) + args
+            with tracing.span(f"Library.{method}", "library"):
+                with self.lock.writing():
+                    result = getattr(self.library, method)(*args, **kwargs)
+            with tracing.span("Library.flush", "library"):
+                self.library.flush()
+        except Exception as error:
+            self.results.put((on_error or self.show_error, error))
+        else:
+            self.results.put((callback, result))
+
+    def run_read(self, method, args, kwargs, callback, on_error):
+        try:
+            with tracing.span(f"Library.{method}", "library"):
+                result = self.read_now(method, *args, **kwargs)
+        except Exception as error:
+            self.results.put((on_error or self.show_error, error))
+        else:
+            self.results.put((callback, result))
+
+    def started(self):
+        self.pending += 1
+        if self.on_busy:
+            self.on_busy(self.pending)
+
+    def poll(self):
+        # runs on the Tk thread, hands finished results to their callbacks
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if callback:
+                callback(result)
+            if self.on_busy:
+                self.on_busy(self.pending)
+        if not self.closed:
+            self.root.after(self.POLL_MS, self.poll)
+
+    @staticmethod
+    def show_error(error):
+        # imported here so ReadWriteLock can be used without Tk (the server does)
+        from tkinter import messagebox
+        messagebox.showwarning("Warning", f"Library operation failed: {error}")
+
+    def shutdown(self):
+        """
+        waits for every call that was already sent to finish, then stops the threads
+        """
+        self.closed = True
+        self.writer.shutdown(wait=True)
+        if self.readers is not self.writer:
+            self.readers.shutdown(wait=True)
+        self.library.flush()